@@ -0,0 +1,181 @@
+"""End-to-end benchmark of the polling pipeline against local fake upstreams.
+
+Every user goes through SUBSCRIBE -> LOCATION -> TYPE -> MORE. Each step is one wave:
+the messages of all users are put into the fake inbox, polled and filtered the way main.main()
+does it, handled by the dispatcher and answered through the outbox. Reports messages per second
+and p50/p99 latency between a message landing in the inbox and its reply reaching the SMS API.
+
+Usage:
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --users 100 1000 --latency 0.02 --error-rate 0.01
+
+Every size runs in a fresh process with its own temporary storage directory.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import fake_upstreams
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_USERS = (100, 10_000, 100_000)
+FIRST_NUMBER = 4915000000000
+CITIES = 500  # distinct cities, so geocoding and places caches are hit like in real traffic
+RESULT_PREFIX = "RESULT "
+PHRASES = {
+    "farewells": ["Bye!"],
+    "subscribe_first": ["Send 'SUBSCRIBE Attraction' first."],
+    "onboards": ["Welcome! Where are you going? Send 'LOCATION city', e.g. "],
+    "cities": ["Paris"],
+    "not_found": ["City not found. Try e.g. "],
+    "new_type": ["That's all. Send 'TYPE newtype' for more."],
+}
+
+
+def conversation(index: int) -> list[str]:
+    """Texts one synthetic user sends, one per wave"""
+    return ["SUBSCRIBE", f"LOCATION City{index % CITIES}", "TYPE catering.cafe", "MORE"]
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def wait_drained(outbox, timeout: float) -> bool:
+    """Waits until the outbox has nothing left to send. Returns False on timeout"""
+    deadline = time.monotonic() + timeout
+    while outbox.outstanding():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def configure_environment(storage_dir: str, sms, geoapify, tinyurl) -> None:
+    """Points the application at the fake upstreams and the temporary storage"""
+    os.environ.update({
+        "STORAGE_DIR": storage_dir,
+        "SMS_API_URL": sms.url,
+        "GEOAPIFY_URL": geoapify.url,
+        "TINYURL_API": f"{tinyurl.url}/api-create.php",
+        "GEOAPIFY_API_KEY": "benchmark",
+        "some_number": str(FIRST_NUMBER),
+        "SMS_RATE": "1000000",
+        "SMS_BURST": "1000000",
+    })
+    for key, phrases in PHRASES.items():
+        os.environ.setdefault(key, json.dumps(phrases))
+
+
+def run(users: int, latency: float, error_rate: float, timeout: float) -> dict:
+    """
+    Runs all waves for the given amount of users in the current process
+
+    :param users: amount of synthetic users
+    :param latency: seconds every fake upstream waits before answering
+    :param error_rate: share of upstream requests answered with 503
+    :param timeout: seconds to wait for the replies of one wave
+    :return: dict with throughput and latency figures
+    """
+    sms = fake_upstreams.start(fake_upstreams.SmsApi(latency, error_rate))
+    geoapify = fake_upstreams.start(fake_upstreams.Geoapify(latency, error_rate))
+    tinyurl = fake_upstreams.start(fake_upstreams.TinyUrl(latency, error_rate))
+    storage_dir = tempfile.mkdtemp(prefix="bench-")
+    configure_environment(storage_dir, sms, geoapify, tinyurl)
+    os.chdir(storage_dir)
+    sys.path.insert(0, BASE_DIR)
+
+    # user_interaction imports main itself, so it has to be imported first
+    import modules.user_interaction as ux
+    import main
+    import modules.outbox as outbox
+
+    main.METRICS_PORT = None
+    main.METRICS_SUMMARY_EVERY = 24 * 3600
+    cursor, dispatcher = main.start_services()
+
+    numbers = [str(FIRST_NUMBER + index) for index in range(users)]
+    texts = [conversation(index) for index in range(users)]
+    waves = []
+    latencies = []
+    started = time.monotonic()
+    for step in range(len(texts[0])):
+        wave_started = time.monotonic()
+        with sms.lock:
+            sent_before = {number: len(sms.sent[number]) for number in numbers}
+        injected = {number: sms.add_message(number, user_texts[step])
+                    for number, user_texts in zip(numbers, texts)}
+        code, api_messages = ux.get_received_messages_api()
+        accepted = main.ingest(cursor, api_messages, dispatcher) if code == 200 else 0
+        dispatcher.join()
+        complete = wait_drained(outbox, timeout)
+        # waves don't overlap, so the first sms a number got during the wave is the reply to its message
+        with sms.lock:
+            for number, received_at in injected.items():
+                replies = sms.sent[number][sent_before[number]:]
+                if replies:
+                    latencies.append(replies[0][0] - received_at)
+        waves.append({"command": texts[0][step].split(" ")[0], "accepted": accepted, "complete": complete,
+                      "seconds": round(time.monotonic() - wave_started, 3)})
+    elapsed = time.monotonic() - started
+    dispatcher.shutdown()
+    replies = sms.sent_count
+    return {
+        "users": users,
+        "messages": users * len(waves),
+        "replies": replies,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(users * len(waves) / elapsed, 1),
+        "answered": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "upstream_requests": {upstream.url: upstream.requests for upstream in (sms, geoapify, tinyurl)},
+        "upstream_errors": sum(upstream.errors for upstream in (sms, geoapify, tinyurl)),
+        "waves": waves,
+    }
+
+
+def run_in_subprocess(users: int, args) -> dict | None:
+    """Runs one size in a fresh interpreter, so module level storage paths and caches start clean"""
+    command = [sys.executable, "-m", "benchmarks.bench_pipeline", "--child", "--users", str(users),
+               "--latency", str(args.latency), "--error-rate", str(args.error_rate), "--timeout", str(args.timeout)]
+    process = subprocess.run(command, cwd=BASE_DIR, capture_output=True, text=True)
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    print(f"Benchmark for {users} users failed with code {process.returncode}:\n{process.stderr[-2000:]}")
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the message pipeline against local fake upstreams")
+    parser.add_argument("--users", type=int, nargs="+", default=list(DEFAULT_USERS))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every upstream request takes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream requests failing with 503")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for the replies of one wave")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run(args.users[0], args.latency, args.error_rate, args.timeout)
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+        os._exit(0)  # worker, sender and logger threads are not waited for
+
+    print(f"{'users':>8} {'messages':>9} {'replies':>8} {'seconds':>9} {'msg/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for users in args.users:
+        result = run_in_subprocess(users, args)
+        if result:
+            print(f"{result['users']:>8} {result['messages']:>9} {result['replies']:>8} {result['seconds']:>9} "
+                  f"{result['messages_per_second']:>9} {result['p50_ms']:>9} {result['p99_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
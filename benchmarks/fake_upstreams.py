@@ -0,0 +1,200 @@
+"""Local stand-ins for Masterschool SMS API, Geoapify geocode/places and TinyURL.
+Every upstream is a small HTTP server running in a background thread with configurable
+latency and error rate, so the whole pipeline can be exercised without network access."""
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+PLACE_CATEGORIES = ("catering.cafe", "catering.restaurant", "tourism.attraction", "tourism.sights.castle",
+                    "entertainment.museum", "leisure.park")
+
+
+class Upstream:
+    """State shared by the handlers of one fake upstream"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        """
+        :param latency: seconds every request waits before it is answered
+        :param error_rate: share of requests answered with 503
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def route(self, method: str, path: str, query: dict, body) -> tuple[int, str, object]:
+        """Answers one request, returns status code, content type and body"""
+        return 404, "text/plain", "Not found"
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class SmsApi(Upstream):
+    """Masterschool SMS API: keeps the team inbox and records every sent sms"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(latency, error_rate)
+        self.inbox = defaultdict(list)
+        self.sent = defaultdict(list)
+        self.sent_count = 0
+        self.sent_event = threading.Condition(self.lock)
+
+    def add_message(self, number, text: str) -> float:
+        """
+        Puts a message into the inbox as if the user texted it
+
+        :return: monotonic time the message was received at
+        """
+        received_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "+0000"
+        with self.lock:
+            self.inbox[str(number)].append({"text": text, "receivedAt": received_at})
+        return time.monotonic()
+
+    def wait_sent(self, count: int, timeout: float) -> bool:
+        """Waits until at least count sms were sent. Returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        with self.sent_event:
+            while self.sent_count < count:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.sent_event.wait(left)
+        return True
+
+    def route(self, method, path, query, body):
+        if method == "POST" and path in ("/team/registerNumber", "/team/unregisterNumber"):
+            return 200, "text/plain", "OK"
+        if method == "GET" and path.startswith("/team/getMessages/"):
+            with self.lock:
+                inbox = {number: list(messages) for number, messages in self.inbox.items()}
+            return 200, "application/json", inbox
+        if method == "POST" and path == "/sms/send":
+            with self.sent_event:
+                self.sent[str(body["phoneNumber"])].append((time.monotonic(), body["message"]))
+                self.sent_count += 1
+                self.sent_event.notify_all()
+            return 200, "text/plain", "Message sent"
+        return super().route(method, path, query, body)
+
+
+def coordinates(text: str) -> tuple[float, float]:
+    """Stable pseudo-random (lat, long) of a text"""
+    digest = hashlib.sha1(text.casefold().encode("utf-8")).digest()
+    lat = int.from_bytes(digest[:4], "big") / 2 ** 32 * 140 - 70
+    long = int.from_bytes(digest[4:8], "big") / 2 ** 32 * 360 - 180
+    return round(lat, 5), round(long, 5)
+
+
+class Geoapify(Upstream):
+    """Geoapify geocode and places. Every city exists except ones starting with 'Nowhere'"""
+
+    def route(self, method, path, query, body):
+        if path == "/v1/geocode/search":
+            text = query.get("text", [""])[0]
+            if text.casefold().startswith("nowhere"):
+                return 200, "application/json", {"features": []}
+            lat, long = coordinates(text)
+            return 200, "application/json", {"features": [{"geometry": {"coordinates": [long, lat]}}]}
+        if path == "/v2/places":
+            requested = query.get("categories", [""])[0].split(",")
+            limit = int(query.get("limit", ["10"])[0])
+            long, lat = (float(value) for value in query.get("filter", ["circle:0,0,0"])[0][7:].split(",")[:2])
+            features = []
+            for index in range(limit):
+                category = requested[index % len(requested)]
+                if "." not in category:
+                    category = next((known for known in PLACE_CATEGORIES if known.startswith(category + ".")),
+                                    category)
+                features.append({
+                    "properties": {"address_line1": f"Place {index} of {category}", "categories": [category]},
+                    "geometry": {"coordinates": [long + index / 1000, lat + index / 1000]}
+                })
+            return 200, "application/json", {"features": features}
+        return super().route(method, path, query, body)
+
+
+class TinyUrl(Upstream):
+    """TinyURL api-create.php"""
+
+    def route(self, method, path, query, body):
+        if path == "/api-create.php":
+            url = query.get("url", [""])[0]
+            return 200, "text/plain", "https://tinyurl.com/" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
+        return super().route(method, path, query, body)
+
+
+def make_handler(upstream: Upstream):
+    """Builds a request handler class that answers with upstream.route()"""
+
+    class FakeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # headers and body are written separately
+
+        def handle_request(self, method: str) -> None:
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            if upstream.latency:
+                time.sleep(upstream.latency)
+            with upstream.lock:
+                upstream.requests += 1
+                failed = random.random() < upstream.error_rate
+                upstream.errors += failed
+            if failed:
+                return self.reply(503, "text/plain", "Service unavailable")
+            parts = urlsplit(self.path)
+            try:
+                body = json.loads(raw) if raw else None
+            except ValueError:
+                return self.reply(400, "text/plain", "Bad json")
+            self.reply(*upstream.route(method, parts.path, parse_qs(parts.query), body))
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+        def reply(self, code: int, content_type: str, payload) -> None:
+            text = payload if isinstance(payload, str) else json.dumps(payload)
+            data = text.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeHandler
+
+
+def start(upstream: Upstream, host: str = "127.0.0.1", port: int = 0) -> Upstream:
+    """
+    Starts the upstream's server in a background thread
+
+    :param upstream: upstream to serve
+    :param host: Interface to listen on
+    :param port: Port to listen on, 0 picks a free one
+    :return: the upstream with its running server
+    """
+    upstream.server = ThreadingHTTPServer((host, port), make_handler(upstream))
+    upstream.server.daemon_threads = True
+    threading.Thread(target=upstream.server.serve_forever, name=type(upstream).__name__, daemon=True).start()
+    return upstream
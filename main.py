@@ -1,27 +1,136 @@
+import asyncio
+import threading
 import time
 
 import modules.user_interaction as ux
-from modules.storage_manager import get_all_messages as get_storage_messages
+import modules.batch_planner as batch_planner
+from modules.dispatcher import Dispatcher
+import modules.outbox as outbox
+import modules.webhook as webhook
+import modules.metrics as metrics
+from modules.storage_manager import load_cursor, save_cursor, advance_cursor, get_pending_messages
 
 DEBUG = False
 SEND_SMS = True
-TIMEOUT = 20
+OUTBOX = True  # queue outgoing sms for the background sender instead of sending them inline
+TIMEOUT = 20  # longest pause between polls when nothing happens
+MIN_TIMEOUT = 2  # pause between polls while messages keep coming
+INGESTION = 'poll'  # 'poll' or 'webhook' (webhook server plus a rare backstop poll)
+WEBHOOK_HOST = '127.0.0.1'  # other interfaces require WEBHOOK_TOKEN
+WEBHOOK_PORT = 8080
+WEBHOOK_POLL_TIMEOUT = 300
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100  # Prometheus text endpoint at /metrics, None to disable
+METRICS_SUMMARY_EVERY = 300  # seconds between metrics summaries in the log
+WORKERS = 8  # phone numbers processed in parallel
+MAX_PENDING = 200  # messages accepted before polling waits for workers
+ASYNC_POLL = False  # poll with asyncio clients instead of the blocking loop
+
+
+_ingest_lock = threading.Lock()
+
+
+def ingest(cursor: dict, api_messages: dict | list, dispatcher: Dispatcher) -> int:
+    """Filters messages that are newer than the cursor and hands them to the dispatcher.
+    Used by both the poller and the webhook server. Returns amount of new messages"""
+    # messages are dispatched under the lock too, so concurrent webhook requests and polls
+    # can't hand messages of the same number to the dispatcher out of order
+    with _ingest_lock:
+        with metrics.timer('filter_seconds'):
+            new_messages = ux.filter_new_messages(cursor, api_messages or {})
+        dispatch(new_messages, dispatcher)
+    return len(new_messages)
+
+
+def dispatch(messages: list, dispatcher: Dispatcher) -> None:
+    """Drops messages that are superseded by later ones of the same batch
+    and hands the effective commands to the dispatcher"""
+    effective, skipped = batch_planner.plan(messages)
+    ux.skip_messages(skipped)
+    metrics.inc('superseded_messages_total', len(skipped))
+    for message, command in effective:
+        dispatcher.submit(message, command)
+
+
+def replay_pending(cursor: dict, dispatcher: Dispatcher) -> int:
+    """Hands messages that were journaled but never handled to the dispatcher.
+    The cursor is advanced over them first: if the process crashed after journaling them
+    but before saving the cursor, the first poll would find them again and run them twice.
+    Returns amount of replayed messages"""
+    pending = get_pending_messages()
+    with _ingest_lock:
+        for message in pending:
+            for number, data in message.items():
+                advance_cursor(cursor, number, data)
+        if pending:
+            save_cursor(cursor)
+        dispatch(pending, dispatcher)
+    return len(pending)
+
+
+def next_timeout(timeout: float, found: bool, max_timeout: float = TIMEOUT) -> float:
+    """Polls often while messages keep coming and backs off twice as long after every idle poll"""
+    return MIN_TIMEOUT if found else min(max_timeout, timeout * 2)
+
+
+def start_services() -> tuple[dict, Dispatcher]:
+    """Loads messages cursor, starts sms sender and metrics, creates the dispatcher"""
+    cursor = load_cursor()
+    if OUTBOX:
+        outbox.start_sender()
+    if METRICS_PORT:
+        try:
+            metrics.start_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            ux.add_log_record(500, f'Metrics endpoint on {METRICS_HOST}:{METRICS_PORT} is disabled: {e}')
+    metrics.start_reporter(METRICS_SUMMARY_EVERY, lambda text: ux.add_log_record(100, text))
+    return cursor, Dispatcher(ux.handle_message, WORKERS, MAX_PENDING,
+                              on_error=lambda text: ux.add_log_record(500, text))
 
 
 def main():
     """Main function loop that fetches messages from Masterschool API,
-    compares them against stored messages. Processes new messages if found"""
+    compares them against messages cursor. Processes new messages if found.
+    In webhook mode messages are pushed to the webhook server and polling is a rare backstop"""
+    cursor, dispatcher = start_services()
+    replay_pending(cursor, dispatcher)
+    max_timeout = TIMEOUT
+    if INGESTION == 'webhook':
+        webhook.start_server(WEBHOOK_HOST, WEBHOOK_PORT, lambda inbox: ingest(cursor, inbox, dispatcher))
+        ux.add_log_record(100, f'Webhook is listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{webhook.WEBHOOK_PATH}')
+        max_timeout = WEBHOOK_POLL_TIMEOUT
+    timeout = MIN_TIMEOUT
     while True:
-        code, api_messages = ux.get_received_messages_api()
-        if code == 200:
-            storage_messages = get_storage_messages()
-            new_messages = ux.filter_new_messages(storage_messages, api_messages)
-            if new_messages:
-                for message in new_messages:
-                    ux.process_new_message(message)
+        with metrics.timer('poll_seconds'):
+            code, api_messages = ux.get_received_messages_api()
+        found = code == 200 and ingest(cursor, api_messages, dispatcher) > 0
+        timeout = next_timeout(timeout, found, max_timeout)
+        time.sleep(timeout)
+
+
+async def async_main():
+    """Asyncio variant of main(): polls Masterschool API with the async client
+    and hands new messages to the dispatcher without blocking the event loop"""
+    from modules import async_clients
 
-        time.sleep(TIMEOUT)
+    cursor, dispatcher = start_services()
+    await asyncio.to_thread(replay_pending, cursor, dispatcher)
+    timeout = MIN_TIMEOUT
+    try:
+        while True:
+            ux.add_log_record(100, "Getting messages from Masterschool's SMS API")
+            with metrics.timer('poll_seconds'):
+                code, api_messages = await async_clients.read_messages(ux.TEAM_NAME)
+            ux.add_log_record(code, 'Messages were successfully collected.' if code == 200 else api_messages)
+            found = code == 200 and await asyncio.to_thread(ingest, cursor, api_messages, dispatcher) > 0
+            timeout = next_timeout(timeout, found)
+            await asyncio.sleep(timeout)
+    finally:
+        await async_clients.close_session()
 
 
 if __name__ == '__main__':
-    main()
+    if ASYNC_POLL:
+        asyncio.run(async_main())
+    else:
+        main()
@@ -0,0 +1,127 @@
+"""Module writes application log records from a background thread.
+Callers only put records into a bounded in-memory queue; obfuscation, formatting,
+writing and rotation happen in the writer thread."""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+from datetime import datetime
+
+import modules.metrics as metrics
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # 'text' or 'json' (one json object per line)
+LOG_ROTATION = os.getenv("LOG_ROTATION", "size")  # 'size' or 'time' (daily)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 5))
+LOG_BUFFER = int(os.getenv("LOG_BUFFER", 10000))  # records kept in memory before new ones are dropped
+
+OBFUSCATE_PATTERNS = (re.compile(r'destination":"(\d*)?"'),
+                      re.compile(r'Number "(\d*)?"'),
+                      re.compile(r'Error: The number "(\d*)?"'))
+
+_loggers = {}
+_listeners = []
+_lock = threading.Lock()
+dropped = 0
+
+
+def obfuscate_text(text: str) -> str:
+    """Hides all but the last 4 digits of phone numbers found in API responses"""
+    for pattern in OBFUSCATE_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            start, end = match.span(1)
+            text = text[:start] + '*' * (end - start - 4) + text[end - 4:]
+    return text
+
+
+class RecordFormatter(logging.Formatter):
+    """Formats records as 'date<TAB>status message' lines or as json lines"""
+
+    def __init__(self, json_lines: bool = False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = obfuscate_text(' '.join(str(record.msg).split('\n')))
+        created = datetime.fromtimestamp(record.created)
+        status = getattr(record, 'status', '')
+        if self.json_lines:
+            return json.dumps({"time": created.isoformat(), "status": status, "message": text},
+                              ensure_ascii=False)
+        return f'{created}\t{status} {text}'
+
+
+class BufferedHandler(logging.handlers.QueueHandler):
+    """Puts records into a bounded queue without blocking; counts records dropped when it's full
+    and warns on stderr when it starts dropping"""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if not dropped:
+                print(f'Log buffer of {LOG_BUFFER} records is full, dropping new records', file=sys.stderr)
+            dropped += 1
+            metrics.inc("log_records_dropped_total")
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatting is left to the writer thread
+        return record
+
+
+def make_file_handler(log_file: str) -> logging.Handler:
+    """Creates a rotating file handler according to LOG_ROTATION"""
+    directory = os.path.dirname(log_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if LOG_ROTATION == 'time':
+        handler = logging.handlers.TimedRotatingFileHandler(log_file, when='midnight', backupCount=LOG_BACKUPS,
+                                                            encoding='utf8')
+    else:
+        handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                                       encoding='utf8')
+    handler.setFormatter(RecordFormatter(json_lines=LOG_FORMAT == 'json'))
+    return handler
+
+
+def get_logger(log_file: str) -> logging.Logger:
+    """Returns a logger that writes to log_file through a background thread, creates it on first use"""
+    with _lock:
+        logger = _loggers.get(log_file)
+        if logger is None:
+            records = queue.Queue(LOG_BUFFER)
+            listener = logging.handlers.QueueListener(records, make_file_handler(log_file))
+            listener.start()
+            _listeners.append(listener)
+            logger = logging.getLogger(f'discoversphere.{log_file}')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(BufferedHandler(records))
+            _loggers[log_file] = logger
+        return logger
+
+
+def log(status, record: str, log_file: str) -> None:
+    """Queues a record with a status code for log_file"""
+    get_logger(log_file).info(record, extra={'status': status})
+
+
+def shutdown() -> None:
+    """Writes all queued records and stops writer threads"""
+    with _lock:
+        for listener in _listeners:
+            listener.stop()
+        _listeners.clear()
+        for logger in _loggers.values():
+            logger.handlers.clear()
+        _loggers.clear()
+
+
+atexit.register(shutdown)
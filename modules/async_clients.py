@@ -0,0 +1,167 @@
+"""Asyncio clients for Masterschool SMS, Geoapify and TinyURL APIs.
+Functions mirror their blocking counterparts and return the same values. Cache keys, parsing of answers,
+the places index, availability records and upstream metrics come from the same helpers the blocking
+clients use. Requests share one connection pool, its connector limits in-flight requests per host."""
+import asyncio
+import json
+import time
+
+import aiohttp
+
+import modules.http_client as http_client
+import modules.places_index as places_index
+from modules.messages_manager import URL
+from modules.attractions import (GEOCODE_URL, PLACES_URL, PLACES_CACHE, PLACES_LIMIT, SHORTEN_DEADLINE,
+                                 cached_location, geocode_params, store_location, places_key, places_params,
+                                 store_places, collect_places)
+from modules.sms_builder import TINYURL_API, URL_CACHE, shorten_params, store_short_url
+
+TOTAL_CONNECTIONS = 200
+PER_HOST_LIMIT = 50
+REQUEST_TIMEOUT = 15
+ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+_session = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Returns the shared client session, creates it on the first call"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=TOTAL_CONNECTIONS, limit_per_host=PER_HOST_LIMIT)
+        _session = aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+    return _session
+
+
+async def close_session() -> None:
+    """Closes the shared client session"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def request(method: str, url: str, **kwargs) -> tuple[int, str]:
+    """
+    Sends a request through the shared session. Measures its latency and counts answers per endpoint
+    like http_client.request() does.
+
+    :return: HTTP status code and response text
+    """
+    session = await get_session()
+    endpoint = http_client.endpoint_of(url)
+    started = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as response:
+            text = await response.text()
+    except ERRORS:
+        http_client.record(endpoint, time.perf_counter() - started, "error")
+        raise
+    http_client.record(endpoint, time.perf_counter() - started, response.status)
+    return response.status, text
+
+
+async def read_messages(team_name: str) -> tuple[int, dict | list | str]:
+    """
+    This function retrieves all messages for the given team.
+    Returns 503 if the API couldn't be reached in time, like the blocking read_messages does.
+    """
+    try:
+        code, text = await request("GET", f"{URL}/team/getMessages/{team_name}")
+        if code == 200:
+            return code, json.loads(text)
+    except (*ERRORS, ValueError):
+        return 503, "Error downloading message."
+    return code, "Error downloading message."
+
+
+async def send_message(number: int, text: str) -> tuple[int, str]:
+    """
+    The function sends an SMS message to the specified number.
+    """
+    body = {"phoneNumber": number, "message": text}
+    try:
+        return await request("POST", f"{URL}/sms/send", json=body)
+    except ERRORS as e:
+        return 503, f"Error: {e}"
+
+
+async def geocode_city_finder(city_name: str, api_key: str) -> tuple | None:
+    """
+    Finds lat and long of the city, see attractions.geocode_city_finder()
+    """
+    key, known, location = cached_location(city_name)
+    if known:
+        return location
+    try:
+        code, text = await request("GET", GEOCODE_URL, params=geocode_params(city_name, api_key))
+        if code != 200:
+            print(f"Error fetching location: {code} {text}")
+            return None
+        return store_location(key, json.loads(text))
+    except (*ERRORS, ValueError) as e:
+        print(f"Error fetching location: {e} ")
+        return None
+
+
+async def fetch_attractions(lat, long, radius, attr_type, api_key, limit=PLACES_LIMIT, offset=0) -> tuple:
+    """
+    Fetches attractions around the location, see attractions.fetch_attractions()
+    """
+    key = places_key(lat, long, radius, attr_type, limit, offset)
+    cached = PLACES_CACHE.get(key)
+    if cached is not None:
+        return 200, cached
+    try:
+        code, text = await request("GET", PLACES_URL,
+                                   params=places_params(lat, long, radius, attr_type, api_key, limit, offset))
+        if code != 200:
+            return code, text
+        return code, store_places(key, json.loads(text))
+    except (*ERRORS, ValueError) as e:
+        return 503, e
+
+
+async def final_fetch(lat, long, radius, attr_type, api_key, shorten=True) -> tuple[int, list]:
+    """
+    Gets places around the location from the places index or Places API, see attractions.final_fetch()
+    """
+    attractions = await asyncio.to_thread(places_index.lookup, lat, long, radius, attr_type)
+    if attractions is not None:
+        status_code = 200
+    else:
+        status_code, attractions = await fetch_attractions(lat, long, radius, attr_type, api_key)
+
+    status_code, places = collect_places(lat, long, radius, attr_type, status_code, attractions)
+    return status_code, await shorten_urls(places) if shorten and places else places
+
+
+async def make_url_short(url: str) -> str:
+    """
+    Shortens url with TinyURL, see sms_builder.make_url_short()
+    """
+    short_url = URL_CACHE.get(url)
+    if short_url:
+        return short_url
+    try:
+        code, text = await request("GET", TINYURL_API, params=shorten_params(url))
+    except ERRORS:
+        return url
+    return store_short_url(url, code, text)
+
+
+async def shorten_urls(places: list, deadline: float = SHORTEN_DEADLINE) -> list:
+    """
+    Shortens urls of places concurrently, see attractions.shorten_urls()
+    """
+    tasks = [asyncio.ensure_future(make_url_short(url)) for _, url in places]
+    await asyncio.wait(tasks, timeout=deadline)
+    results = []
+    for (name, url), task in zip(places, tasks):
+        if task.done() and not task.exception():
+            url = task.result()
+        else:
+            task.cancel()
+        results.append((name, url))
+    return results
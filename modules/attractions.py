@@ -1,9 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
+from random import choice
 import requests
 import os
+import modules.http_client as http_client
+import threading
+import unicodedata
+from modules.cache import PersistentCache
 from modules.sms_builder import make_url_short
+import modules.categories as categories
+import modules.places_index as places_index
 load_dotenv()
 
+GEOAPIFY_URL = os.getenv("GEOAPIFY_URL", "https://api.geoapify.com")
+GEOCODE_URL = f"{GEOAPIFY_URL}/v1/geocode/search"
+PLACES_URL = f"{GEOAPIFY_URL}/v2/places"
+MAPS_URL = "https://www.google.com/maps/place/"
+PLACES_LIMIT = 10
+SHORTEN_WORKERS = 10
+SHORTEN_DEADLINE = 3  # seconds to wait for short urls before sending long ones
+
+_shortener_pool = ThreadPoolExecutor(max_workers=SHORTEN_WORKERS, thread_name_prefix="shortener")
+GEOCODE_CACHE = PersistentCache("geocode",
+                                max_size=int(os.getenv("GEOCODE_CACHE_SIZE", 2000)),
+                                ttl=float(os.getenv("GEOCODE_CACHE_TTL", 180 * 24 * 3600)))
+# places results are shared between users asking for the same category around the same tile
+PLACES_TILE = 0.01  # degrees, roughly 1 km
+PLACES_CACHE = PersistentCache("places", persist=False,
+                               max_size=int(os.getenv("PLACES_CACHE_SIZE", 5000)),
+                               ttl=float(os.getenv("PLACES_CACHE_TTL", 6 * 3600)))
+# which categories were empty or not around a tile, used to pick surprises
+AVAILABILITY = PersistentCache("availability",
+                               max_size=int(os.getenv("AVAILABILITY_CACHE_SIZE", 2000)),
+                               ttl=float(os.getenv("AVAILABILITY_TTL", 7 * 24 * 3600)))
+SURPRISE_LIMIT = 50
+SURPRISE_ATTEMPTS = 3
+_availability_lock = threading.Lock()
+# cities that weren't found are remembered for a shorter time
+GEOCODE_MISSING_CACHE = PersistentCache("geocode_missing",
+                                        max_size=int(os.getenv("GEOCODE_CACHE_SIZE", 2000)),
+                                        ttl=float(os.getenv("GEOCODE_MISSING_TTL", 24 * 3600)))
+
 
 def get_api_key():
     """Gets API key from the environment."""
@@ -13,6 +50,14 @@ def get_api_key():
     return api_key
 
 
+def normalize_city(city_name: str) -> str:
+    """Builds a cache key out of a city name: case-folded, without diacritics
+    and with collapsed whitespace, so 'São  Paulo' and 'sao paulo' match"""
+    decomposed = unicodedata.normalize("NFKD", city_name)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(stripped.casefold().split())
+
+
 def geocode_city_finder(city_name, api_key):
     """We are using Geo-apify Geocoding API to fetch
         latitude and longitude of a city
@@ -24,27 +69,59 @@ def geocode_city_finder(city_name, api_key):
         Returns:
             tuple: Lat and Long of the city or None if not found
             """
-    url = "https://api.geoapify.com/v1/geocode/search"
-    params = {
-        "text": city_name,
-        "apiKey": api_key
-    }
+    key, known, location = cached_location(city_name)
+    if known:
+        return location
     try:
-        response = requests.get(url, params=params)
+        response = http_client.get(GEOCODE_URL, params=geocode_params(city_name, api_key))
         response.raise_for_status()
-        data = response.json()
-        if "features" in data and len(data["features"]) > 0:
-            # Fetching first result that matches
-            location = data["features"][0]["geometry"]["coordinates"]
-            return location[1], location[0]
-        else:
-            return None
+        return store_location(key, response.json())
     except requests.exceptions.RequestException as e:
         print(f"Error fetching location: {e} ")
         return None
 
 
-def fetch_attractions(lat, long, radius, attr_type, api_key):
+def cached_location(city_name: str) -> tuple[str, bool, tuple | None]:
+    """
+    Looks a city up in the geocode caches. Shared with the asyncio client.
+
+    :return: tuple: cache key, True if the answer is cached and (lat, long) or None if the city wasn't found
+    """
+    key = normalize_city(city_name)
+    cached = GEOCODE_CACHE.get(key)
+    if cached:
+        return key, True, tuple(cached)
+    if GEOCODE_MISSING_CACHE.get(key):
+        return key, True, None
+    return key, False, None
+
+
+def geocode_params(city_name: str, api_key: str) -> dict:
+    """Geocoding API query parameters"""
+    return {"text": city_name, "apiKey": api_key}
+
+
+def store_location(key: str, data: dict) -> tuple | None:
+    """
+    Takes Geocoding API answer and caches city's location or that it wasn't found
+
+    :return: (lat, long) of the first matching result or None
+    """
+    if data.get("features"):
+        location = data["features"][0]["geometry"]["coordinates"]
+        GEOCODE_CACHE.set(key, [location[1], location[0]])
+        return location[1], location[0]
+    GEOCODE_MISSING_CACHE.set(key, True)
+    return None
+
+
+def places_key(lat, long, radius, attr_type, limit=PLACES_LIMIT, offset=0) -> str:
+    """Builds places cache key out of a quantized coordinate tile, category, radius, results limit and offset"""
+    key = f"{round(float(lat) / PLACES_TILE)}:{round(float(long) / PLACES_TILE)}:{attr_type}:{radius}:{limit}"
+    return f"{key}:{offset}" if offset else key
+
+
+def fetch_attractions(lat, long, radius, attr_type, api_key, limit=PLACES_LIMIT, offset=0):
     """Fetch desired attraction creating a unique request
        regarding users likes
 
@@ -54,37 +131,54 @@ def fetch_attractions(lat, long, radius, attr_type, api_key):
         radius (int): Radius for the search in meters.
         attr_type (str): Category of the attraction.
         api_key (str):API key.
+        limit (int): Maximum amount of attractions.
+        offset (int): Amount of attractions to skip, for paging.
 
     Returns:
         HTTP status code and list of attractions or None
     """
-    url = "https://api.geoapify.com/v2/places"
+    key = places_key(lat, long, radius, attr_type, limit, offset)
+    cached = PLACES_CACHE.get(key)
+    if cached is not None:
+        return 200, cached
+    try:
+        response = http_client.get(PLACES_URL, params=places_params(lat, long, radius, attr_type, api_key,
+                                                                    limit, offset))
+        response.raise_for_status()
+        return response.status_code, store_places(key, response.json())
+    except requests.exceptions.RequestException as e:
+        if 'apiKey' in str(e):
+            print(f"Error: Something unexpected happened while fetching attractions.")
+        else:
+            print(f"Error: {e}")
+        status_code = e.response.status_code if e.response is not None else 503
+        return status_code, e
+
+
+def places_params(lat, long, radius, attr_type, api_key, limit=PLACES_LIMIT, offset=0) -> dict:
+    """Places API query parameters. Shared with the asyncio client"""
     params = {
         "categories": attr_type,  # e.g. tourism.attraction or 1.2 in screenshot
         # radius in meters from center. e.g. '5000' for 5km
         "filter": f"circle:{long},{lat},{radius}",
         # results limit
-        "limit": 10,
+        "limit": limit,
         "apiKey": api_key,
         "lang": "en"
     }
-    try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
-        attractions = data.get("features", [])
-        return response.status_code, attractions
-    except requests.exceptions.RequestException as e:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        if 'apiKey' in str(e):
-            print(f"Error: Something unexpected happened while fetching attractions.")
-        else:
-            print(f"Error: {e}")
-        return response.status_code, e
+    if offset:
+        params["offset"] = offset
+    return params
+
+
+def store_places(key: str, data: dict) -> list:
+    """Takes Places API answer, caches and returns its features"""
+    attractions = data.get("features", [])
+    PLACES_CACHE.set(key, attractions)
+    return attractions
 
 
-def final_fetch(lat, long, radius, attr_type, api_key):
+def final_fetch(lat, long, radius, attr_type, api_key, shorten=True):
     """
     Uses the existing fetch_attractions() to process the attractions
     and returns a tuple with code and list of names and short url.
@@ -94,26 +188,133 @@ def final_fetch(lat, long, radius, attr_type, api_key):
         radius (int): Radius for the search in meters.
         attr_type (str): Category of the attraction.
         api_key (str):API key.
+        shorten (bool): If False, long Google Maps urls are returned, so they can be shortened on demand.
 
     :return: tuple: HTTP status code and list of tuples (name, short url).
     """
-    status_code, attractions = fetch_attractions(lat, long, radius, attr_type, api_key)
+    attractions = places_index.lookup(lat, long, radius, attr_type)
+    if attractions is not None:
+        status_code = 200
+    else:
+        status_code, attractions = fetch_attractions(lat, long, radius, attr_type, api_key)
+
+    status_code, places = collect_places(lat, long, radius, attr_type, status_code, attractions)
+    return status_code, shorten_urls(places) if shorten and places else places
+
+
+def collect_places(lat, long, radius, attr_type, status_code, attractions) -> tuple[int, list]:
+    """
+    Records if places of the category were found around the location and turns found features into places.
+    Shared with the asyncio client.
 
+    :return: tuple: HTTP status code and list of tuples (name, Google Maps url)
+    """
     if status_code != 200 or not attractions:
+        if status_code == 200:
+            record_availability(lat, long, radius, {attr_type: False})
         return status_code, []
+    record_availability(lat, long, radius, {attr_type: True})
+    return status_code, features_to_places(attractions)
 
-    results = []
+
+def features_to_places(attractions: list) -> list:
+    """
+    Turns Geoapify features into a list of tuples (name, Google Maps url).
+    Features without a name are skipped.
+    """
+    places = []
     for attr in attractions:
-        # Extract details name and short url
-        address_line1 = attr["properties"]["address_line1"]
+        # Extract details name and long url
+        address_line1 = attr["properties"].get("address_line1")
         coord = attr["geometry"]["coordinates"]
-        url_base = "https://www.google.com/maps/place/"
-        url_attr = f"{url_base}{coord[1]},{coord[0]}"
-        short_url = make_url_short(url_attr)
         if address_line1:
-            results.append((address_line1, short_url))
+            places.append((address_line1, f"{MAPS_URL}{coord[1]},{coord[0]}"))
+    return places
+
+
+def availability_key(lat, long, radius) -> str:
+    """Builds availability map key out of a quantized coordinate tile and radius"""
+    return f"{round(float(lat) / PLACES_TILE)}:{round(float(long) / PLACES_TILE)}:{radius}"
+
 
-    return status_code, results
+def record_availability(lat, long, radius, found_categories: dict) -> None:
+    """
+    Remembers which categories have places around a location.
+
+    :param found_categories: dict with categories as keys and True if places were found as values
+    """
+    key = availability_key(lat, long, radius)
+    with _availability_lock:
+        # the cached dict may be read by other threads, so a changed copy replaces it
+        known = dict(AVAILABILITY.get(key) or {})
+        if all(known.get(category) == found for category, found in found_categories.items()):
+            return
+        known.update(found_categories)
+        AVAILABILITY.set(key, known)
+
+
+def surprise_fetch(lat, long, radius, api_key, shorten=True):
+    """
+    Picks a random category that has places around the location and fetches them.
+    Categories known to be non-empty are tried first. If nothing is known about the
+    location, a single Places query over all category groups finds the non-empty ones.
+
+    :return: tuple: HTTP status code, picked category and list of tuples (name, url).
+    """
+    with _availability_lock:
+        known = dict(AVAILABILITY.get(availability_key(lat, long, radius)) or {})
+    candidates = [category for category, found in known.items() if found]
+    for _ in range(min(SURPRISE_ATTEMPTS, len(candidates))):
+        category = choice(candidates)
+        code, places = final_fetch(lat, long, radius, category, api_key, shorten)
+        if code == 200 and places:
+            return code, category, places
+        candidates.remove(category)
+
+    groups = [group for group in categories.get_registry().groups if known.get(group) is not False]
+    if not groups:
+        return 200, None, []
+    code, features = fetch_attractions(lat, long, radius, ",".join(groups), api_key, limit=SURPRISE_LIMIT)
+    if code != 200 or not isinstance(features, list):
+        return code, None, []
+    if not features:
+        record_availability(lat, long, radius, {group: False for group in groups})
+        return code, None, []
+
+    by_category = {}
+    for feature in features:
+        for category in feature["properties"].get("categories", []):
+            if categories.is_category(category):
+                by_category.setdefault(category, []).append(feature)
+    record_availability(lat, long, radius, {category: True for category in by_category})
+    named = {category: places for category, places in
+             ((category, features_to_places(items)) for category, items in by_category.items()) if places}
+    if not named:
+        return code, None, []
+    category = choice(list(named))
+    places = named[category][:PLACES_LIMIT]
+    return code, category, shorten_urls(places) if shorten else places
+
+
+def shorten_urls(places: list, deadline: float = SHORTEN_DEADLINE) -> list:
+    """
+    Shortens urls of places concurrently. Places whose url wasn't shortened
+    before the deadline keep the long url.
+
+    :param places: list of tuples (name, long url)
+    :param deadline: seconds to wait for all short urls
+    :return: list of tuples (name, url)
+    """
+    futures = [_shortener_pool.submit(make_url_short, url) for _, url in places]
+    wait(futures, timeout=deadline)
+    results = []
+    for (name, url), future in zip(places, futures):
+        if future.done() and not future.exception():
+            url = future.result()
+        else:
+            future.cancel()
+        results.append((name, url))
+    return results
 
 
 def search_and_display(city_name, attraction_type, radius=5000):
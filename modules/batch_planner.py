@@ -0,0 +1,61 @@
+"""Module plans a batch of new messages before they are handled. For every phone number
+LOCATION and TYPE commands that are overridden by a later command of the same batch are dropped
+and consecutive MOREs are merged into one, so bursts don't cost geocoding, Places queries and sms
+for answers nobody waits for anymore"""
+import modules.commands as parser
+
+# later command -> earlier commands of the same number it makes pointless
+SUPERSEDES = {
+    "LOCATION": frozenset({"LOCATION", "TYPE"}),  # new location resets the attractions type
+    "TYPE": frozenset({"TYPE"}),
+}
+
+
+def more_count(command: parser.Command) -> int:
+    """Amount of attractions a MORE command asks for"""
+    return max(1, int(command.argument)) if command.argument else 1
+
+
+def plan(messages: list) -> tuple[list, list]:
+    """
+    Decides which messages of a batch have to be run
+
+    :param messages: list of {number: message} dicts in receiving order
+    :return: tuple: list of tuples ({number: message}, Command) to run, in receiving order,
+             and list of tuples ({number: message}, reason) of messages that don't have to be run
+    """
+    parsed = parser.parse_batch(messages)
+    commands = [command for _, _, command in parsed]
+    reasons = {}
+
+    by_number = {}
+    for index, (number, _, _) in enumerate(parsed):
+        by_number.setdefault(str(number), []).append(index)
+    for indexes in by_number.values():
+        later = None
+        for index in reversed(indexes):
+            if later is not None and commands[index].name in SUPERSEDES.get(commands[later].name, ()):
+                reasons[index] = f"Superseded by {commands[later].name} {commands[later].argument}".strip()
+                continue
+            later = index
+
+        merged_into = None
+        for index in indexes:
+            if index in reasons:
+                continue
+            command = commands[index]
+            if command.name != "MORE":
+                merged_into = None
+                continue
+            if merged_into is not None:
+                count = more_count(commands[merged_into]) + more_count(command)
+                if count <= parser.MAX_COUNT:
+                    commands[merged_into] = command._replace(argument=str(count))
+                    reasons[index] = "Merged into the previous MORE"
+                    continue
+            merged_into = index
+
+    effective = [({number: data}, commands[index])
+                 for index, (number, data, _) in enumerate(parsed) if index not in reasons]
+    superseded = [({parsed[index][0]: parsed[index][1]}, reason) for index, reason in sorted(reasons.items())]
+    return effective, superseded
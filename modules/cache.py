@@ -0,0 +1,145 @@
+"""Module provides a bounded LRU cache with TTL, optionally persisted to sqlite"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORAGE_DIR = os.getenv("STORAGE_DIR", os.path.join(BASE_DIR, "storage"))
+DB_FILE = os.path.join(STORAGE_DIR, "cache.db")
+PRUNE_EVERY = 100  # writes between trimming the on-disk table
+
+CACHES = []  # every cache created in the process, for metrics
+
+
+class PersistentCache:
+    """In-memory LRU cache that fronts an on-disk sqlite table.
+    Values must be json serializable. Entries older than ttl seconds are treated as absent."""
+
+    def __init__(self, name: str, max_size: int = 1000, ttl: float | None = None,
+                 persist: bool = True, disk_size: int | None = None):
+        """
+        :param name: Name of the cache, used as sqlite table name
+        :param max_size: Amount of entries kept in memory
+        :param ttl: Time to live of an entry in seconds, None for no expiration
+        :param persist: If False, cache lives in memory only
+        :param disk_size: Amount of entries kept on disk (10 * max_size by default)
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+        self.disk_size = disk_size or max_size * 10
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._connection = None
+        self._writes = 0
+        CACHES.append(self)
+
+    def _db(self) -> sqlite3.Connection:
+        """Opens the sqlite connection and creates cache's table on first use"""
+        if self._connection is None:
+            os.makedirs(STORAGE_DIR, exist_ok=True)
+            self._connection = sqlite3.connect(DB_FILE, check_same_thread=False, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(f'CREATE TABLE IF NOT EXISTS "{self.name}" ('
+                                     'key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)')
+            self._connection.commit()
+        return self._connection
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _remember(self, key: str, value, stored_at: float) -> None:
+        """Puts an entry to memory evicting the least recently used one if needed"""
+        self._memory[key] = (value, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str, default=None):
+        """
+        Gets a value from the cache
+
+        :param key: Cache key
+        :param default: Value to return if key is absent or expired
+        :return: Cached value or default
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None and self.persist:
+                try:
+                    row = self._db().execute(f'SELECT value, stored_at FROM "{self.name}" WHERE key = ?',
+                                             (key,)).fetchone()
+                except sqlite3.Error as e:
+                    print(f"Error reading {self.name} cache: {e}")
+                    row = None
+                if row:
+                    entry = (json.loads(row[0]), row[1])
+                    self._remember(key, *entry)
+            if entry is None or self._expired(entry[1]):
+                self.misses += 1
+                return default
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, value) -> None:
+        """
+        Stores a value in the cache
+
+        :param key: Cache key
+        :param value: Json serializable value
+        """
+        stored_at = time.time()
+        with self._lock:
+            self._remember(key, value, stored_at)
+            if not self.persist:
+                return
+            try:
+                connection = self._db()
+                with connection:
+                    connection.execute(f'INSERT OR REPLACE INTO "{self.name}" (key, value, stored_at) '
+                                       'VALUES (?, ?, ?)', (key, json.dumps(value, ensure_ascii=False), stored_at))
+                self._writes += 1
+                if self._writes >= PRUNE_EVERY:
+                    self._writes = 0
+                    self.prune()
+            except sqlite3.Error as e:
+                print(f"Error saving {self.name} cache: {e}")
+
+    def prune(self) -> None:
+        """Removes expired entries and the oldest ones above disk_size from the disk"""
+        with self._lock:
+            connection = self._db()
+            with connection:
+                if self.ttl is not None:
+                    connection.execute(f'DELETE FROM "{self.name}" WHERE stored_at < ?',
+                                       (time.time() - self.ttl,))
+                connection.execute(f'DELETE FROM "{self.name}" WHERE key NOT IN '
+                                   f'(SELECT key FROM "{self.name}" ORDER BY stored_at DESC LIMIT ?)',
+                                   (self.disk_size,))
+
+    def clear(self) -> None:
+        """Removes all entries from memory and disk"""
+        with self._lock:
+            self._memory.clear()
+            if self.persist:
+                connection = self._db()
+                with connection:
+                    connection.execute(f'DELETE FROM "{self.name}"')
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters of the cache"""
+        total = self.hits + self.misses
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "size": len(self._memory)
+        }
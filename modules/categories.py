@@ -0,0 +1,194 @@
+"""Module keeps the registry of supported attraction types loaded once from static/attractions_types.json
+and resolves user's TYPE input to them by exact name, prefix or closest spelling"""
+import json
+import os
+from bisect import bisect_right
+from random import choice, randrange
+from types import MappingProxyType
+from typing import NamedTuple
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CATEGORIES_FILE = os.path.join(BASE_DIR, "static", "attractions_types.json")
+SHORTLIST_SIZE = 3
+FUZZY_ACCEPT = 0.6  # similarity needed to pick a misspelled category without asking
+FUZZY_MARGIN = 0.1  # and how much better than the runner-up it has to be
+FUZZY_SUGGEST = 0.45  # similarity needed to suggest a category
+
+
+class Match(NamedTuple):
+    """Result of resolving user's input: the category to use or a ranked shortlist to suggest"""
+    best: str | None
+    shortlist: tuple
+
+
+class Registry(NamedTuple):
+    """Immutable view of the attraction types"""
+    categories: tuple  # groups followed by their children, in file order
+    category_set: frozenset
+    groups: tuple
+    children: MappingProxyType  # group -> tuple of its children
+    terms: MappingProxyType  # full names and last name parts -> categories
+    trie: MappingProxyType  # read-only nested nodes by character, '' key holds categories reachable from the node
+    grams: MappingProxyType  # trigram -> terms containing it
+    by_length: tuple  # categories sorted by name length
+    lengths: tuple  # name lengths of by_length, for bisecting
+
+
+def normalize_term(text: str) -> str:
+    """Case-folds text and joins words with underscores like category names do"""
+    return "_".join(text.casefold().split())
+
+
+def trigrams(term: str) -> set:
+    """Splits a padded term into character trigrams"""
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def build_trie(terms: dict) -> MappingProxyType:
+    """Builds a read-only character trie over terms. Every node keeps the frozenset of categories
+    of all terms below it"""
+    root = {"": set()}
+    for term, term_categories in terms.items():
+        node = root
+        node[""].update(term_categories)
+        for char in term:
+            node = node.setdefault(char, {"": set()})
+            node[""].update(term_categories)
+    return freeze_node(root)
+
+
+def freeze_node(node: dict) -> MappingProxyType:
+    """Turns a trie node and all nodes below it into read-only mappings"""
+    return MappingProxyType({key: frozenset(value) if key == "" else freeze_node(value)
+                             for key, value in node.items()})
+
+
+def load_registry(path: str = CATEGORIES_FILE) -> Registry:
+    """
+    Reads attraction types file and builds a registry out of it
+
+    :param path: Path to the json file with groups as keys and lists of children as values
+    :return: Registry
+    """
+    with open(path, "r", encoding="utf8") as file:
+        groups = json.load(file)
+    categories = []
+    for group, children in groups.items():
+        categories += [group] + children
+    terms = {}
+    for category in categories:
+        for term in {category, category.split(".")[-1]}:
+            terms.setdefault(term.casefold(), set()).add(category)
+    grams = {}
+    for term in terms:
+        for gram in trigrams(term):
+            grams.setdefault(gram, set()).add(term)
+    return Registry(categories=tuple(categories),
+                    category_set=frozenset(categories),
+                    groups=tuple(groups),
+                    children=MappingProxyType({group: tuple(children) for group, children in groups.items()}),
+                    terms=MappingProxyType({term: frozenset(found) for term, found in terms.items()}),
+                    trie=build_trie(terms),
+                    grams=MappingProxyType({gram: frozenset(found) for gram, found in grams.items()}),
+                    by_length=tuple(sorted(categories, key=len)),
+                    lengths=tuple(sorted(map(len, categories))))
+
+
+_registry = load_registry()
+
+
+def reload_registry(path: str = CATEGORIES_FILE) -> Registry:
+    """Re-reads attraction types file and replaces the registry"""
+    global _registry
+    _registry = load_registry(path)
+    return _registry
+
+
+def get_registry() -> Registry:
+    """Returns current registry"""
+    return _registry
+
+
+def is_category(name: str) -> bool:
+    """Checks if name is a supported attraction type"""
+    return name in _registry.category_set
+
+
+def random_category(max_length: int | None = None, exclude: str | None = None) -> str | None:
+    """
+    Returns a random attraction type. Picks directly among the names that fit,
+    so there is no retrying.
+
+    :param max_length: Maximum length of the name
+    :param exclude: Name that must not be returned
+    :return: Attraction type or None if no name fits
+    """
+    registry = _registry
+    if max_length is None and exclude is None:
+        return choice(registry.categories)
+    fitting = len(registry.by_length) if max_length is None else bisect_right(registry.lengths, max_length)
+    skip = exclude in registry.category_set and (max_length is None or len(exclude) <= max_length)
+    if fitting - skip <= 0:
+        return None
+    category = registry.by_length[randrange(fitting - skip)]
+    if skip and category == exclude:
+        # exclude is inside the fitting prefix, so the last fitting name takes its place
+        category = registry.by_length[fitting - 1]
+    return category
+
+
+def shortest_length() -> int:
+    """Returns length of the shortest attraction type"""
+    return _registry.lengths[0]
+
+
+def rank(found) -> tuple:
+    """Orders categories by length and name, so broader and shorter ones go first"""
+    return tuple(sorted(found, key=lambda category: (len(category), category)))
+
+
+def match_category(text: str) -> Match:
+    """
+    Resolves user's input to a supported category.
+    Tries exact name (case-insensitive), exact last name part ('museum' -> 'entertainment.museum'),
+    name prefix and finally trigram similarity for typos.
+
+    :param text: User's input
+    :return: Match with the best category or a shortlist of suggestions (both may be empty)
+    """
+    registry = _registry
+    term = normalize_term(text)
+    if not term:
+        return Match(None, ())
+    if term in registry.category_set:
+        return Match(term, ())
+    found = registry.terms.get(term)
+    if found:
+        return Match(next(iter(found)), ()) if len(found) == 1 else Match(None, rank(found)[:SHORTLIST_SIZE])
+
+    node = registry.trie
+    for char in term:
+        node = node.get(char)
+        if node is None:
+            break
+    else:
+        found = node[""]
+        if len(found) == 1:
+            return Match(next(iter(found)), ())
+        return Match(None, rank(found)[:SHORTLIST_SIZE])
+
+    term_grams = trigrams(term)
+    shared = {}
+    for gram in term_grams:
+        for candidate in registry.grams.get(gram, ()):
+            shared[candidate] = shared.get(candidate, 0) + 1
+    scores = {}
+    for candidate, count in shared.items():
+        score = 2 * count / (len(term_grams) + len(candidate) + 1)
+        for category in registry.terms[candidate]:
+            scores[category] = max(score, scores.get(category, 0))
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], len(item[0]), item[0]))
+    if ranked and ranked[0][1] >= FUZZY_ACCEPT and (len(ranked) == 1 or ranked[0][1] - ranked[1][1] >= FUZZY_MARGIN):
+        return Match(ranked[0][0], ())
+    return Match(None, tuple(category for category, score in ranked[:SHORTLIST_SIZE] if score >= FUZZY_SUGGEST))
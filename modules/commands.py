@@ -0,0 +1,103 @@
+"""Module parses sms texts into commands. The first word of a text is looked up case-insensitively
+in a table compiled once from the command specs, the rest of the text is the command's argument"""
+from functools import lru_cache
+from types import MappingProxyType
+from typing import NamedTuple
+
+FALLBACK = "DOCS"  # command of texts that don't start with a known command
+# argument kinds
+NONE = "none"  # argument is ignored
+OPTIONAL = "optional"
+REQUIRED = "required"  # commands without it fall back to FALLBACK
+COUNT = "count"  # optional positive number, anything else is ignored
+MAX_COUNT = 5  # COUNT arguments are capped to it
+PARSE_CACHE_SIZE = 4096
+
+
+class Spec(NamedTuple):
+    """Describes one command: its name, other words that mean it and what argument it takes"""
+    name: str
+    aliases: tuple = ()
+    argument: str = OPTIONAL
+
+
+class Command(NamedTuple):
+    """Parsed sms text"""
+    name: str  # canonical command name
+    argument: str  # text after the command word with collapsed whitespace, '' if there is none
+    valid: bool  # False if the text didn't start with a known command or missed a required argument
+
+
+SPECS = (
+    Spec("SUBSCRIBE", ("SUB", "START"), OPTIONAL),
+    Spec("UNSUBSCRIBE", ("UNSUB", "STOP"), OPTIONAL),
+    Spec("LOCATION", ("CITY", "LOC"), REQUIRED),
+    Spec("TYPE", ("CATEGORY",), REQUIRED),
+    Spec("MORE", ("NEXT",), COUNT),
+    Spec(FALLBACK, ("HELP",), OPTIONAL),
+)
+
+
+def compile_table(specs=SPECS) -> MappingProxyType:
+    """
+    Builds a lookup table of command words
+
+    :param specs: iterable of Spec
+    :return: read-only dict with upper-cased names and aliases as keys and specs as values
+    """
+    table = {}
+    for spec in specs:
+        for word in (spec.name, *spec.aliases):
+            word = word.upper()
+            if word in table:
+                raise ValueError(f"Command word {word} is used by both {table[word].name} and {spec.name}")
+            table[word] = spec
+    return MappingProxyType(table)
+
+
+TABLE = compile_table()
+
+
+def parse(text: str, table=TABLE) -> Command:
+    """
+    Parses an sms text into a command. Texts starting with an unknown word
+    or missing a required argument become FALLBACK commands with the whole text as the argument.
+
+    :param text: sms text
+    :param table: lookup table built by compile_table()
+    :return: Command
+    """
+    if table is TABLE:
+        return _parse_default(text)
+    return _parse(text, table)
+
+
+def _parse(text: str, table) -> Command:
+    words = text.split(None, 1)
+    spec = table.get(words[0].upper()) if words else None
+    argument = " ".join(words[1].split()) if len(words) > 1 else ""
+    if spec is None or (spec.argument == REQUIRED and not argument):
+        return Command(FALLBACK, " ".join(words[0:1] + [argument]).strip(), False)
+    if spec.argument == NONE or (spec.argument == COUNT and not argument.isdigit()):
+        argument = ""
+    elif spec.argument == COUNT:
+        argument = str(min(int(argument), MAX_COUNT))
+    return Command(spec.name, argument, True)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_default(text: str) -> Command:
+    """Parses with the default table. Most texts are repeated ('MORE', 'TYPE surprise'), so results are cached"""
+    return _parse(text, TABLE)
+
+
+def parse_batch(messages: list, table=TABLE) -> list:
+    """
+    Parses every message of a poll
+
+    :param messages: list of {number: message} dicts
+    :param table: lookup table built by compile_table()
+    :return: list of tuples (number, message, Command) in the same order
+    """
+    return [(number, data, parse(data["text"], table))
+            for message in messages for number, data in message.items()]
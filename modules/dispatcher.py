@@ -0,0 +1,77 @@
+"""Module runs message handlers in a thread pool keeping per-number order"""
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import modules.metrics as metrics
+
+
+class Dispatcher:
+    """Processes messages of different phone numbers in parallel.
+    Messages of the same number are handled one by one in the order they were submitted,
+    so LOCATION -> TYPE -> MORE sequences stay consistent.
+    Submitting blocks once max_pending messages are waiting or in progress (backpressure).
+    """
+
+    def __init__(self, handler, max_workers: int = 8, max_pending: int = 100, on_error=print):
+        """
+        :param handler: function that takes one {number: message} dict
+        :param max_workers: amount of phone numbers processed at the same time
+        :param max_pending: amount of messages accepted before submit() starts blocking
+        :param on_error: function that takes the error text with its traceback when the handler crashes
+        """
+        self.handler = handler
+        self.on_error = on_error
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dispatcher')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._queues = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, message: dict, *args) -> None:
+        """Queues a message for processing. Blocks while the dispatcher is full.
+        Extra args are passed to the handler after the message."""
+        number = str(next(iter(message)))
+        self._slots.acquire()
+        with self._lock:
+            self._pending += 1
+            queue = self._queues.get(number)
+            if queue is not None:
+                queue.append((message, args))
+                return
+            self._queues[number] = deque([(message, args)])
+        self._executor.submit(self._drain, number)
+
+    def _drain(self, number: str) -> None:
+        """Handles messages of one number until its queue is empty"""
+        while True:
+            with self._lock:
+                queue = self._queues[number]
+                if not queue:
+                    del self._queues[number]
+                    return
+                message, args = queue.popleft()
+            try:
+                self.handler(message, *args)
+            except Exception as e:
+                metrics.inc("handler_errors_total", error=type(e).__name__)
+                self.on_error(f'Error while processing message: {e}\n{traceback.format_exc()}')
+            finally:
+                self._slots.release()
+                with self._lock:
+                    self._pending -= 1
+                    if not self._pending:
+                        self._idle.notify_all()
+
+    def join(self, timeout: float | None = None) -> bool:
+        """Waits until all submitted messages are processed.
+        Returns False if timeout expired first."""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self) -> None:
+        """Waits for submitted messages and stops worker threads"""
+        self.join()
+        self._executor.shutdown()
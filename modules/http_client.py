@@ -0,0 +1,87 @@
+"""Module keeps one pooled keep-alive requests session per upstream host,
+with default timeouts and retries of idempotent requests"""
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import modules.metrics as metrics
+
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 20))
+TIMEOUT = (float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)), float(os.getenv("HTTP_READ_TIMEOUT", 15)))
+RETRIES = int(os.getenv("HTTP_RETRIES", 2))
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def make_session() -> requests.Session:
+    """Creates a session that keeps up to POOL_SIZE connections alive
+    and retries GET requests on connection errors and 502/503/504 answers"""
+    retry = Retry(total=RETRIES, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                  allowed_methods=frozenset({"GET", "HEAD"}), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    """Returns the session of url's host, creates it on first use"""
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = _sessions[host] = make_session()
+        return session
+
+
+def endpoint_of(url: str) -> str:
+    """Host and path of url, used as the metrics label of upstream requests"""
+    parts = urlsplit(url)
+    return parts.netloc + parts.path
+
+
+def record(endpoint: str, seconds: float, code) -> None:
+    """Records latency and answer of an upstream request, shared with the asyncio clients"""
+    metrics.observe("upstream_seconds", seconds, endpoint=endpoint)
+    metrics.inc("upstream_requests_total", endpoint=endpoint, code=code)
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """Sends a request through the host's pooled session with the default timeout.
+    Measures its latency and counts answers per endpoint"""
+    kwargs.setdefault("timeout", TIMEOUT)
+    endpoint = endpoint_of(url)
+    started = time.perf_counter()
+    try:
+        response = get_session(url).request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        record(endpoint, time.perf_counter() - started, "error")
+        raise
+    record(endpoint, time.perf_counter() - started, response.status_code)
+    return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """requests.get through the host's pooled session with the default timeout"""
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """requests.post through the host's pooled session with the default timeout"""
+    return request("POST", url, **kwargs)
+
+
+def close_sessions() -> None:
+    """Closes all pooled connections"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
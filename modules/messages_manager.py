@@ -1,9 +1,23 @@
+import os
 import requests
 
-URL = "http://hackathons.masterschool.com:3030"
+import modules.http_client as http_client
+
+URL = os.getenv("SMS_API_URL", "http://hackathons.masterschool.com:3030")
 team_name = "Attraction"
 
 
+def post_json(url: str, body: dict) -> tuple[int, str]:
+    """
+    Posts json body to the API. Returns 503 if the API couldn't be reached in time.
+    """
+    try:
+        response = http_client.post(url, json=body)
+    except requests.exceptions.RequestException as e:
+        return 503, f"Error: {e}"
+    return response.status_code, response.text
+
+
 def register_number(number: int) -> tuple[int, str]:
     """
     Registers a phone number to the specified team.
@@ -11,8 +25,7 @@ def register_number(number: int) -> tuple[int, str]:
     url = f"{URL}/team/registerNumber"
     headers = {"Content-type": "application/json"}
     body = {"phoneNumber": number, "teamName": team_name}
-    response = requests.post(url, json=body)
-    return response.status_code, response.text
+    return post_json(url, body)
 
 
 def unregister_number(number: int) -> tuple[int, str]:
@@ -22,8 +35,7 @@ def unregister_number(number: int) -> tuple[int, str]:
     url = f"{URL}/team/unregisterNumber"
     headers = {"Content-type": "application/json"}
     body = {"phoneNumber": number, "teamName": team_name}
-    response = requests.post(url, json=body)
-    return response.status_code, response.text
+    return post_json(url, body)
 
 
 def read_messages(team_name: str) -> tuple[int, list | str]:
@@ -31,7 +43,10 @@ def read_messages(team_name: str) -> tuple[int, list | str]:
     This function retrieves all messages for the given team.
     """
     url = f"{URL}/team/getMessages/{team_name}"
-    response = requests.get(url)
+    try:
+        response = http_client.get(url)
+    except requests.exceptions.RequestException:
+        return 503, "Error downloading message."
     if response.status_code == 200:
         return response.status_code, response.json()
     return response.status_code, "Error downloading message."
@@ -44,8 +59,7 @@ def send_message(number: int, text: str) -> tuple[int, str]:
     url = f"{URL}/sms/send"
     headers = {"Content-type": "application/json"}
     body = {"phoneNumber": number, "message": text}
-    response = requests.post(url, json=body)
-    return response.status_code, response.text
+    return post_json(url, body)
 
 
 def run_tests():
@@ -0,0 +1,157 @@
+"""Module collects counters and latency histograms of the message pipeline
+and exposes them in Prometheus text format and as a periodic log summary"""
+import threading
+import time
+from contextlib import ContextDecorator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from modules.cache import CACHES
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+
+
+def labels_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """Increases a counter"""
+    key = (name, labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    """Adds an observation to a histogram"""
+    key = (name, labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+                break
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+class timer(ContextDecorator):
+    """Measures time of a block or a function call into a histogram:
+    `with metrics.timer('poll_seconds'):` or `@metrics.timer('storage_write_seconds', store='users')`"""
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+        self._started = threading.local()
+
+    def __enter__(self):
+        self._started.__dict__.setdefault('stack', []).append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self._started.stack.pop(), **self.labels)
+        return False
+
+
+def format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = [f'{key}="{value}"' for key, value in labels + extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def quantile(histogram: dict, q: float) -> float:
+    """Estimates a quantile as the upper bound of the bucket it falls into"""
+    target = q * histogram["count"]
+    seen = 0
+    for bound, count in zip(BUCKETS, histogram["buckets"]):
+        seen += count
+        if seen >= target:
+            return bound
+    return BUCKETS[-1]
+
+
+def render() -> str:
+    """Renders all metrics in Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]})
+                            for key, value in _histograms.items())
+    for (name, labels), value in counters:
+        lines.append(f'{name}{format_labels(labels)} {value}')
+    for (name, labels), histogram in histograms:
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else str(bound)
+            lines.append(f'{name}_bucket{format_labels(labels, (("le", le),))} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]}')
+        lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+    for cache in CACHES:
+        stats = cache.stats()
+        labels = (("cache", stats["name"]),)
+        lines.append(f'cache_hits_total{format_labels(labels)} {stats["hits"]}')
+        lines.append(f'cache_misses_total{format_labels(labels)} {stats["misses"]}')
+        lines.append(f'cache_hit_ratio{format_labels(labels)} {stats["hit_ratio"]:.4f}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> str:
+    """Builds a one-line summary: count, average and p50/p99 of every histogram and cache hit ratios"""
+    with _lock:
+        histograms = sorted(_histograms.items())
+        parts = []
+        for (name, labels), histogram in histograms:
+            if not histogram["count"]:
+                continue
+            label_text = ','.join(value for _, value in labels)
+            parts.append(f'{name}[{label_text}] n={histogram["count"]} '
+                         f'avg={histogram["sum"] / histogram["count"]:.3f}s '
+                         f'p50<={quantile(histogram, 0.5)}s p99<={quantile(histogram, 0.99)}s')
+    for cache in CACHES:
+        stats = cache.stats()
+        if stats["hits"] + stats["misses"]:
+            parts.append(f'cache[{stats["name"]}] hit_ratio={stats["hit_ratio"]:.2f}')
+    return 'Metrics: ' + ('; '.join(parts) if parts else 'no data yet')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host: str, port: int) -> ThreadingHTTPServer:
+    """Serves /metrics from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def start_reporter(interval: float, report) -> threading.Thread:
+    """Calls report(summary()) every interval seconds from a background thread"""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            report(summary())
+
+    thread = threading.Thread(target=run, name='metrics-reporter', daemon=True)
+    thread.start()
+    return thread
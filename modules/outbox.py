@@ -0,0 +1,227 @@
+"""Module keeps outbound SMS in a durable sqlite queue and sends them from a background worker
+with a token-bucket rate limit and exponential backoff. Every message has an idempotency key,
+so enqueueing the same reply twice (e.g. when an inbound message is replayed) sends it once."""
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from modules.messages_manager import send_message
+import modules.metrics as metrics
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORAGE_DIR = os.getenv("STORAGE_DIR", os.path.join(BASE_DIR, "storage"))
+DB_FILE = os.path.join(STORAGE_DIR, "outbox.db")
+RATE = float(os.getenv("SMS_RATE", 5))  # messages per second
+BURST = int(os.getenv("SMS_BURST", 10))
+MAX_ATTEMPTS = int(os.getenv("SMS_MAX_ATTEMPTS", 6))
+# finished messages are kept this long, so replayed inbound messages still find their reply keys
+RETENTION = float(os.getenv("SMS_RETENTION_DAYS", 7)) * 24 * 3600
+PRUNE_EVERY = int(os.getenv("SMS_PRUNE_EVERY", 500))  # sends between retention prunes
+BACKOFF_BASE = 2  # seconds, doubled after every failed attempt
+BACKOFF_MAX = 300
+BATCH_SIZE = 50
+
+PENDING, SENDING, SENT, FAILED, UNKNOWN = "pending", "sending", "sent", "failed", "unknown"
+
+_connection = None
+_lock = threading.RLock()
+_wakeup = threading.Event()
+_sender = None
+
+
+def get_connection() -> sqlite3.Connection:
+    """Opens the outbox database once per process and creates the queue table"""
+    global _connection
+    with _lock:
+        if _connection is None:
+            os.makedirs(STORAGE_DIR, exist_ok=True)
+            connection = sqlite3.connect(DB_FILE, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    key TEXT PRIMARY KEY, number TEXT NOT NULL, text TEXT NOT NULL,
+                    status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL, created REAL NOT NULL,
+                    last_code INTEGER, last_error TEXT);
+                CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+                CREATE INDEX IF NOT EXISTS outbox_created ON outbox (created);
+            """)
+            _connection = connection
+        return _connection
+
+
+def enqueue(number: int, text: str, key: str | None = None) -> bool:
+    """
+    Puts an SMS to the outbox
+
+    :param number: Recipient's phone number
+    :param text: SMS text
+    :param key: Idempotency key, random if not provided
+    :return: True if queued, False if a message with the same key was queued before
+    """
+    now = time.time()
+    connection = get_connection()
+    with _lock, connection:
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO outbox (key, number, text, status, next_attempt, created) "
+            "VALUES (?, ?, ?, ?, ?, ?)", (key or uuid.uuid4().hex, str(number), text, PENDING, now, now))
+    _wakeup.set()
+    return cursor.rowcount == 1
+
+
+def due_messages(limit: int = BATCH_SIZE) -> list:
+    """Returns pending messages whose next attempt time has come, oldest first"""
+    with _lock:
+        return get_connection().execute(
+            "SELECT key, number, text, attempts FROM outbox WHERE status = ? AND next_attempt <= ? "
+            "ORDER BY created LIMIT ?", (PENDING, time.time(), limit)).fetchall()
+
+
+def next_due_in() -> float | None:
+    """Returns seconds until the next pending message is due or None if there are none"""
+    with _lock:
+        row = get_connection().execute("SELECT MIN(next_attempt) FROM outbox WHERE status = ?",
+                                       (PENDING,)).fetchone()
+    return None if row[0] is None else max(0.0, row[0] - time.time())
+
+
+def outstanding() -> int:
+    """Returns amount of messages that are still waiting to be sent or being sent"""
+    with _lock:
+        return get_connection().execute("SELECT COUNT(*) FROM outbox WHERE status IN (?, ?)",
+                                        (PENDING, SENDING)).fetchone()[0]
+
+
+def set_status(key: str, status: str, **fields) -> None:
+    """Updates message's status and other columns"""
+    assignments = ", ".join(["status = ?"] + [f"{field} = ?" for field in fields])
+    connection = get_connection()
+    with _lock, connection:
+        connection.execute(f"UPDATE outbox SET {assignments} WHERE key = ?", (status, *fields.values(), key))
+
+
+def recover() -> int:
+    """
+    Marks messages that were being sent when the process stopped as 'unknown'.
+    The provider may have accepted them, so they are not sent again.
+
+    :return: Amount of such messages
+    """
+    connection = get_connection()
+    with _lock, connection:
+        return connection.execute("UPDATE outbox SET status = ? WHERE status = ?", (UNKNOWN, SENDING)).rowcount
+
+
+def prune(max_age: float = RETENTION) -> int:
+    """
+    Deletes sent, failed and unknown messages created more than max_age seconds ago
+
+    :return: Amount of deleted messages
+    """
+    connection = get_connection()
+    with _lock, connection:
+        return connection.execute("DELETE FROM outbox WHERE status NOT IN (?, ?) AND created < ?",
+                                  (PENDING, SENDING, time.time() - max_age)).rowcount
+
+
+class TokenBucket:
+    """Allows rate events per second on average with bursts up to capacity"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def acquire(self) -> None:
+        """Blocks until a token is available and takes it"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+def backoff(attempts: int) -> float:
+    """Seconds to wait before the next attempt, with jitter"""
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+def send_one(key: str, number: str, text: str, attempts: int) -> int:
+    """
+    Sends one queued message and records the result
+
+    :return: HTTP status code, 0 if request failed
+    """
+    set_status(key, SENDING)
+    try:
+        code, response = send_message(int(number), text)
+    except Exception as e:
+        code, response = 0, str(e)
+    attempts += 1
+    metrics.inc("sms_send_total", code=code)
+    if code == 200:
+        set_status(key, SENT, attempts=attempts, last_code=code, last_error=None)
+    elif attempts >= MAX_ATTEMPTS:
+        set_status(key, FAILED, attempts=attempts, last_code=code, last_error=response)
+        print(f"Giving up sending sms {key} after {attempts} attempts: {code} {response}")
+    else:
+        set_status(key, PENDING, attempts=attempts, last_code=code, last_error=response,
+                   next_attempt=time.time() + backoff(attempts))
+    return code
+
+
+class Sender(threading.Thread):
+    """Background worker that drains the outbox"""
+
+    def __init__(self, rate: float = RATE, burst: int = BURST):
+        super().__init__(name="sms-sender", daemon=True)
+        self.bucket = TokenBucket(rate, burst)
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        recovered = recover()
+        if recovered:
+            print(f"{recovered} sms were interrupted while sending and won't be resent")
+        prune()
+        sends = 0
+        while not self.stopped.is_set():
+            _wakeup.clear()
+            batch = due_messages()
+            for key, number, text, attempts in batch:
+                if self.stopped.is_set():
+                    return
+                self.bucket.acquire()
+                send_one(key, number, text, attempts)
+                sends += 1
+                if sends % PRUNE_EVERY == 0:
+                    prune()
+            if not batch:
+                _wakeup.wait(min(next_due_in() or 1.0, 1.0))
+
+    def stop(self) -> None:
+        self.stopped.set()
+        _wakeup.set()
+
+
+def start_sender() -> Sender:
+    """Starts the background sender once per process"""
+    global _sender
+    with _lock:
+        if _sender is None or not _sender.is_alive():
+            _sender = Sender()
+            _sender.start()
+        return _sender
+
+
+def stop_sender() -> None:
+    """Stops the background sender"""
+    if _sender is not None:
+        _sender.stop()
+        _sender.join()
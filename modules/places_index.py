@@ -0,0 +1,206 @@
+"""Module builds and queries an offline index of Geoapify places for the busiest cities.
+Build or refresh it with `python -m modules.places_index [city ...] [--max-age DAYS]`"""
+import argparse
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from modules.sms_builder import get_attractions_list
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORAGE_DIR = os.getenv("STORAGE_DIR", os.path.join(BASE_DIR, "storage"))
+INDEX_FILE = os.path.join(STORAGE_DIR, "places_index.db")
+CITIES_FILE = os.path.join(BASE_DIR, "static", "top_cities.json")
+INDEX_RADIUS = 15000  # meters around the city center covered by the index
+INDEX_LIMIT = 100  # places fetched per request while indexing
+INDEX_MAX_PAGES = 5  # a city and category with more places than pages * limit isn't marked as covered
+RESULTS_LIMIT = 10
+EARTH_RADIUS = 6371000
+METERS_PER_DEGREE = 111320
+SCHEMA_VERSION = 1
+
+_connection = None
+_lock = threading.Lock()
+
+
+def get_connection(create: bool = False) -> sqlite3.Connection | None:
+    """
+    Opens the index database once per process.
+
+    :param create: Create the database if it doesn't exist
+    :return: sqlite connection or None if there is no index yet
+    """
+    global _connection
+    with _lock:
+        if _connection is None:
+            if not create and not os.path.exists(INDEX_FILE):
+                return None
+            os.makedirs(STORAGE_DIR, exist_ok=True)
+            connection = sqlite3.connect(INDEX_FILE, check_same_thread=False)
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS coverage (
+                    city TEXT, category TEXT, lat REAL, lon REAL, radius REAL, built_at REAL,
+                    PRIMARY KEY (city, category));
+                CREATE INDEX IF NOT EXISTS coverage_category ON coverage (category);
+                CREATE TABLE IF NOT EXISTS places (
+                    id INTEGER PRIMARY KEY, city TEXT, category TEXT, name TEXT, lat REAL, lon REAL);
+                CREATE INDEX IF NOT EXISTS places_city ON places (city, category);
+                CREATE VIRTUAL TABLE IF NOT EXISTS places_rtree USING rtree(
+                    id, min_lat, max_lat, min_lon, max_lon);
+            """)
+            if connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                # indexes built before paging kept a single page of places, they can't be trusted as complete
+                with connection:
+                    connection.execute("""
+                        DELETE FROM coverage WHERE (city, category) IN (
+                            SELECT city, category FROM places GROUP BY city, category HAVING COUNT(*) >= ?)""",
+                                       (INDEX_LIMIT,))
+                    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            _connection = connection
+        return _connection
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Haversine distance between two points in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def lookup(lat: float, lon: float, radius: float, attr_type: str) -> list | None:
+    """
+    Finds places of a category around a point in the offline index.
+
+    :return: list of Geoapify-like features (may be empty) if the index covers the whole search circle,
+             None if the network has to be asked
+    """
+    connection = get_connection()
+    if connection is None:
+        return None
+    with _lock:
+        covered = connection.execute("SELECT lat, lon, radius FROM coverage WHERE category = ?",
+                                     (attr_type,)).fetchall()
+        if not any(distance(lat, lon, c_lat, c_lon) + radius <= c_radius for c_lat, c_lon, c_radius in covered):
+            return None
+        d_lat = radius / METERS_PER_DEGREE
+        d_lon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        rows = connection.execute("""
+            SELECT places.name, places.lat, places.lon FROM places_rtree
+            JOIN places ON places.id = places_rtree.id
+            WHERE places_rtree.min_lat >= ? AND places_rtree.max_lat <= ?
+              AND places_rtree.min_lon >= ? AND places_rtree.max_lon <= ?
+              AND places.category = ?""",
+                                  (lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon, attr_type)).fetchall()
+    found = sorted((distance(lat, lon, p_lat, p_lon), name, p_lat, p_lon) for name, p_lat, p_lon in rows)
+    return [{"properties": {"address_line1": name}, "geometry": {"coordinates": [p_lon, p_lat]}}
+            for place_distance, name, p_lat, p_lon in found if place_distance <= radius][:RESULTS_LIMIT]
+
+
+def index_city(city: str, api_key: str, categories: list, radius: int = INDEX_RADIUS) -> int:
+    """
+    Fetches places of every category around the city and replaces city's entries in the index.
+    A category is marked as covered only if all its places were fetched, otherwise lookup()
+    keeps asking the network for it.
+
+    :return: Amount of indexed places
+    """
+    from modules.attractions import geocode_city_finder
+
+    coords = geocode_city_finder(city, api_key)
+    if not coords:
+        print(f"City {city} not found, skipping")
+        return 0
+    lat, lon = coords
+    connection = get_connection(create=True)
+    indexed = 0
+    for category in categories:
+        code, features, complete = fetch_all(lat, lon, radius, category, api_key)
+        if code != 200:
+            print(f"Failed to fetch {category} for {city}: {code}")
+            continue
+        places = [(feature["properties"]["address_line1"], *reversed(feature["geometry"]["coordinates"][:2]))
+                  for feature in features if feature["properties"].get("address_line1")]
+        with _lock, connection:
+            old_ids = [row[0] for row in connection.execute(
+                "SELECT id FROM places WHERE city = ? AND category = ?", (city, category))]
+            connection.executemany("DELETE FROM places_rtree WHERE id = ?", [(i,) for i in old_ids])
+            connection.execute("DELETE FROM places WHERE city = ? AND category = ?", (city, category))
+            for name, p_lat, p_lon in places:
+                place_id = connection.execute(
+                    "INSERT INTO places (city, category, name, lat, lon) VALUES (?, ?, ?, ?, ?)",
+                    (city, category, name, p_lat, p_lon)).lastrowid
+                connection.execute("INSERT INTO places_rtree VALUES (?, ?, ?, ?, ?)",
+                                   (place_id, p_lat, p_lat, p_lon, p_lon))
+            if complete:
+                connection.execute("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?, ?)",
+                                   (city, category, lat, lon, radius, time.time()))
+            else:
+                connection.execute("DELETE FROM coverage WHERE city = ? AND category = ?", (city, category))
+        if not complete:
+            print(f"{city} has more than {len(features)} places of {category}, they are left to the network")
+        indexed += len(places)
+    return indexed
+
+
+def fetch_all(lat: float, lon: float, radius: int, category: str, api_key: str) -> tuple[int, list, bool]:
+    """
+    Pages through Places results of a category until they run out or INDEX_MAX_PAGES pages were fetched
+
+    :return: tuple: HTTP status code, list of features and True if all places were fetched
+    """
+    from modules.attractions import fetch_attractions
+
+    features = []
+    for page in range(INDEX_MAX_PAGES):
+        code, page_features = fetch_attractions(lat, lon, radius, category, api_key,
+                                                limit=INDEX_LIMIT, offset=page * INDEX_LIMIT)
+        if code != 200 or not isinstance(page_features, list):
+            return code, features, False
+        features += page_features
+        if len(page_features) < INDEX_LIMIT:
+            return code, features, True
+    return 200, features, False
+
+
+def stale_cities(cities: list, max_age: float) -> list:
+    """Returns cities that aren't indexed yet or were indexed more than max_age seconds ago"""
+    connection = get_connection(create=True)
+    with _lock:
+        built = dict(connection.execute("SELECT city, MIN(built_at) FROM coverage GROUP BY city").fetchall())
+    return [city for city in cities if time.time() - built.get(city, 0) > max_age]
+
+
+def build_index(cities: list | None = None, max_age: float = 0) -> None:
+    """
+    Builds or refreshes the index for cities (top_cities.json by default).
+
+    :param cities: List of city names
+    :param max_age: Only cities indexed more than max_age seconds ago are refreshed
+    """
+    from modules.attractions import get_api_key
+
+    if not cities:
+        with open(CITIES_FILE, "r", encoding="utf-8") as file:
+            cities = json.load(file)
+    api_key = get_api_key()
+    categories = get_attractions_list()
+    for city in stale_cities(cities, max_age):
+        print(f"Indexing {city}: {index_city(city, api_key, categories)} places")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build offline places index for the busiest cities")
+    parser.add_argument("cities", nargs="*", help="cities to index (default: static/top_cities.json)")
+    parser.add_argument("--max-age", type=float, default=0,
+                        help="refresh only cities indexed more than this amount of days ago")
+    args = parser.parse_args()
+    build_index(args.cities, args.max_age * 24 * 3600)
+
+
+if __name__ == "__main__":
+    main()
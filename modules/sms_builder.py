@@ -2,44 +2,93 @@ import os
 from dotenv import load_dotenv
 import json
 from random import randint
-import requests
 import string
 
+from modules.cache import PersistentCache
+import modules.categories as categories
+import modules.sms_segments as sms_segments
+import modules.http_client as http_client
+
 
 load_dotenv()
 ATTRACTIONS_LONG = 'https://raw.githubusercontent.com/e-kif/DiscoverSphere/refs/heads/main/static/attractions_types.json'
 ATTRACTIONS = 'https://tinyurl.com/2yyxqodb'
+TINYURL_API = os.getenv('TINYURL_API', 'https://tinyurl.com/api-create.php')
+URL_CACHE = PersistentCache('short_urls',
+                            max_size=int(os.getenv('URL_CACHE_SIZE', 5000)),
+                            ttl=float(os.getenv('URL_CACHE_TTL', 90 * 24 * 3600)))
+
+
+SMS_LIMIT = sms_segments.GSM_SINGLE  # hint texts are plain GSM-7, so one segment holds this many characters
+TYPES_END = f'TYPE surprise\nFull list: {ATTRACTIONS}'
+_phrases = {}
+
+
+def get_phrases(env_key: str) -> tuple:
+    """Returns phrases list from the environment, parsed once per key"""
+    phrases = _phrases.get(env_key)
+    if phrases is None:
+        phrases = _phrases[env_key] = tuple(json.loads(os.getenv(env_key)))
+    return phrases
+
+
+def reload_phrases() -> None:
+    """Forgets parsed phrases, so they are read from the environment again"""
+    _phrases.clear()
 
 
 def get_random_item(env_key: str) -> str:
-    items = json.loads(os.getenv(env_key))
-    index = randint(0, len(items) - 1)
-    return items[index]
+    items = get_phrases(env_key)
+    return items[randint(0, len(items) - 1)]
+
 
+def pick_two_types(budget: int) -> tuple[str, str] | None:
+    """Picks two different random attraction types with total length within budget"""
+    type1 = categories.random_category(budget - categories.shortest_length())
+    if type1 is None:
+        return None
+    type2 = categories.random_category(budget - len(type1), exclude=type1)
+    if type2 is None:
+        return None
+    return type1, type2
 
-def get_attractions_list(storage: str = os.path.join('static', 'attractions_types.json')) -> list:
-    with open(storage, 'r', encoding='utf8') as file:
-        attractions = json.loads(file.read())
-    all_attractions = []
-    for key, value in attractions.items():
-        all_attractions += [key] + value
-    return all_attractions
+
+def is_plain_text(text: str) -> bool:
+    return all([char in string.ascii_letters + ' ' for char in text])
+
+
+def get_attractions_list(storage: str = categories.CATEGORIES_FILE) -> list:
+    if storage != categories.CATEGORIES_FILE:
+        return list(categories.load_registry(storage).categories)
+    return list(categories.get_registry().categories)
 
 
 def get_random_attraction_type():
-    attractions = get_attractions_list()
-    return attractions[randint(0, len(attractions) - 1)]
+    return categories.random_category()
 
 
 def make_url_short(url: str):
-    request_url = 'https://tinyurl.com/api-create.php?url=' + url
+    short_url = URL_CACHE.get(url)
+    if short_url:
+        return short_url
     try:
-        response = requests.get(request_url)
+        response = http_client.get(TINYURL_API, params=shorten_params(url))
     except Exception:
         return url
-    if response.status_code != 200:
+    return store_short_url(url, response.status_code, response.text)
+
+
+def shorten_params(url: str) -> dict:
+    """TinyURL query parameters, shared with the asyncio client"""
+    return {'url': url}
+
+
+def store_short_url(url: str, code: int, text: str) -> str:
+    """Caches TinyURL answer. Returns the short url or the original one if shortening failed"""
+    if code != 200:
         return url
-    return response.text
+    URL_CACHE.set(url, text)
+    return text
 
 
 def goodbye_text():
@@ -62,31 +111,19 @@ def city_not_found_text():
 
 
 def attraction_type_text(location: str = ''):
-    start = f'Provide places type for {location}. Examples:\n'
-    end = f'TYPE surprise\nFull list: {ATTRACTIONS}'
-    for _ in range(30):
-        if not all([char in string.ascii_letters + ' ' for char in location]) or not location:
-            break
-        type1 = get_random_attraction_type()
-        while True:
-            type2 = get_random_attraction_type()
-            if type2 != type1:
-                break
-        type1 = f'TYPE {type1}, '
-        type2 = f'TYPE {type2}, '
-        full_text = start + type1 + type2 + end
-        if len(full_text) < 171:
-            return full_text
-    type1 = get_random_attraction_type()
-    while True:
-        type2 = get_random_attraction_type()
-        if type2 != type1:
-            break
-    type1 = f'TYPE {type1}, '
-    type2 = f'TYPE {type2}, '
+    end = TYPES_END
+    separators = len('TYPE , ') * 2
+    if location and is_plain_text(location):
+        start = f'Provide places type for {location}. Examples:\n'
+        types = pick_two_types(SMS_LIMIT - len(start) - len(end) - separators)
+        if types:
+            return f'{start}TYPE {types[0]}, TYPE {types[1]}, {end}'
     start = 'Provide places type. Examples:\n'
-    full_text = start + type1 + type2 + end
-    return full_text if len(full_text) < 171 else start + type1 + end
+    types = pick_two_types(SMS_LIMIT - len(start) - len(end) - separators)
+    if types:
+        return f'{start}TYPE {types[0]}, TYPE {types[1]}, {end}'
+    type1 = categories.random_category(SMS_LIMIT - len(start) - len(end) - separators // 2)
+    return f'{start}TYPE {type1}, {end}'
 
 
 def newtype_text():
@@ -94,21 +131,48 @@ def newtype_text():
 
 
 def wrong_attraction_text(attr_type: str = ''):
-    type1 = get_random_attraction_type()
-    while True:
-        type2 = get_random_attraction_type()
-        if type2 != type1:
-            break
-    type1 = f'TYPE {type1}\n'
-    type2 = f'TYPE {type2}\n'
-    end = f'TYPE surprise\nFull list: {ATTRACTIONS}'
-    if attr_type and all([char in string.ascii_letters + ' ' for char in attr_type]):
+    end = TYPES_END
+    separators = len('TYPE \n') * 2
+    if attr_type and is_plain_text(attr_type):
         start = f"Can't find {attr_type} among supported places types. Try again:\n"
-        full_text = start + type1 + type2 + end
-        if len(full_text) < 171:
-            return full_text
+        types = pick_two_types(SMS_LIMIT - len(start) - len(end) - separators)
+        if types:
+            return f'{start}TYPE {types[0]}\nTYPE {types[1]}\n{end}'
     start = 'Wrong places type. Try some of these:\n'
-    return start + type1 + type2 + end
+    type1, type2 = pick_two_types(SMS_LIMIT - len(start) - len(end) - separators)
+    return f'{start}TYPE {type1}\nTYPE {type2}\n{end}'
+
+
+def suggest_attraction_text(attr_type: str, suggestions: tuple) -> str:
+    end = TYPES_END
+    start = 'Did you mean:\n'
+    if attr_type and is_plain_text(attr_type):
+        start = f"Can't find {attr_type}. Did you mean:\n"
+    full_text = start + end
+    for suggestion in reversed(suggestions):
+        text = start + f'TYPE {suggestion}\n' + full_text[len(start):]
+        if len(text) <= SMS_LIMIT:
+            full_text = text
+    return full_text
+
+
+def pack_texts(texts: list, separator: str = '\n\n') -> list:
+    """Joins texts into as few sms as possible. A text is appended to the previous sms
+    only if that takes fewer segments than sending it separately.
+
+    :return: list of tuples (sms text, amount of joined texts)
+    """
+    packed = []
+    for text in texts:
+        if packed:
+            last, amount = packed[-1]
+            joined = last + separator + text
+            if (sms_segments.analyze(joined).segments <
+                    sms_segments.analyze(last).segments + sms_segments.analyze(text).segments):
+                packed[-1] = (joined, amount + 1)
+                continue
+        packed.append((text, 1))
+    return packed
 
 
 def main():
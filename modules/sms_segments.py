@@ -0,0 +1,103 @@
+"""Module calculates SMS encoding and segments count and fits texts into fewer segments.
+A text with any character outside GSM 03.38 alphabet is sent as UCS-2 with 70 characters per segment."""
+import math
+import os
+import unicodedata
+from typing import NamedTuple
+
+GSM_BASIC = frozenset("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+                      "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM_EXTENDED = frozenset("^{}\\[~]|€\f")  # take two septets each
+GSM_SINGLE, GSM_MULTI = 160, 153
+UCS2_SINGLE, UCS2_MULTI = 70, 67
+REPLACEMENTS = {
+    "‘": "'", "’": "'", "‚": "'", "“": '"', "”": '"', "„": '"', "«": '"', "»": '"',
+    "–": "-", "—": "-", "‐": "-", "…": "...", " ": " ", "•": "*", "ł": "l", "Ł": "L",
+    "đ": "d", "Đ": "D", "œ": "oe", "Œ": "OE", "ı": "i"
+}
+# 'off' sends texts as they are, 'transliterate' replaces accented letters when it makes a text GSM-7,
+# 'trim' also shortens texts to a single segment
+FIT_MODE = os.getenv("SMS_FIT", "transliterate")
+
+
+class SegmentInfo(NamedTuple):
+    encoding: str  # 'GSM-7' or 'UCS-2'
+    units: int  # septets for GSM-7, UTF-16 code units for UCS-2
+    segments: int
+
+
+def is_gsm(text: str) -> bool:
+    """Checks if text can be sent with GSM-7 encoding"""
+    return all(char in GSM_BASIC or char in GSM_EXTENDED for char in text)
+
+
+def analyze(text: str) -> SegmentInfo:
+    """
+    Calculates encoding, length in encoding units and billed segments of a text
+
+    :param text: SMS text
+    :return: SegmentInfo
+    """
+    if is_gsm(text):
+        units = len(text) + sum(char in GSM_EXTENDED for char in text)
+        single, multi, encoding = GSM_SINGLE, GSM_MULTI, "GSM-7"
+    else:
+        units = len(text.encode("utf-16-le")) // 2
+        single, multi, encoding = UCS2_SINGLE, UCS2_MULTI, "UCS-2"
+    segments = 1 if units <= single else math.ceil(units / multi)
+    return SegmentInfo(encoding, units, segments)
+
+
+def transliterate(text: str) -> str:
+    """
+    Replaces characters outside GSM-7 with their closest GSM-7 spelling ('ş' -> 's', '’' -> "'").
+    Returns the original text if some characters can't be replaced, since it stays UCS-2 anyway.
+    """
+    result = []
+    for char in text:
+        if char in GSM_BASIC or char in GSM_EXTENDED:
+            result.append(char)
+            continue
+        replacement = REPLACEMENTS.get(char)
+        if replacement is None:
+            decomposed = unicodedata.normalize("NFKD", char)
+            replacement = "".join(part for part in decomposed if not unicodedata.combining(part))
+        if not replacement or not is_gsm(replacement):
+            return text
+        result.append(replacement)
+    return "".join(result)
+
+
+def trim(text: str) -> str:
+    """
+    Shortens text to a single segment. The last line (usually a link) is kept whole,
+    the lines before it are cut and end with '...'.
+    """
+    info = analyze(text)
+    limit = GSM_SINGLE if info.encoding == "GSM-7" else UCS2_SINGLE
+    if info.segments == 1:
+        return text
+    head, newline, tail = text.rpartition("\n")
+    if not newline or analyze(tail).units > limit - 4:
+        head, tail = text, ""
+    else:
+        tail = newline + tail
+    while head and analyze(head + "..." + tail).units > limit:
+        head = head[:-1]
+    return head.rstrip() + "..." + tail
+
+
+def fit(text: str, mode: str | None = None) -> tuple[str, SegmentInfo]:
+    """
+    Prepares text for sending according to fit mode.
+
+    :param text: SMS text
+    :param mode: 'off', 'transliterate' or 'trim' (FIT_MODE by default)
+    :return: Text to send and its SegmentInfo
+    """
+    mode = mode or FIT_MODE
+    if mode in ("transliterate", "trim") and not is_gsm(text):
+        text = transliterate(text)
+    if mode == "trim":
+        text = trim(text)
+    return text, analyze(text)
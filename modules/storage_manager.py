@@ -1,61 +1,313 @@
+import hashlib
 import json
 import os
+import threading
+from datetime import datetime
+from typing import Iterator
 from modules.messages_manager import read_messages
+import modules.metrics as metrics
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-STORAGE_DIR = os.path.join(BASE_DIR, "storage")
+STORAGE_DIR = os.getenv("STORAGE_DIR", os.path.join(BASE_DIR, "storage"))
 STORAGE_FILE = os.path.join(STORAGE_DIR, "messages.json")
+JOURNAL_FILE = os.path.join(STORAGE_DIR, "messages.jsonl")
+CURSOR_FILE = os.path.join(STORAGE_DIR, "cursor.json")
+# journal is compacted once it grows over this size, keeping the latest records of every number
+JOURNAL_MAX_BYTES = 5 * 1024 * 1024
+JOURNAL_KEEP_PER_NUMBER = 20
+COMPACT_CHECK_EVERY = 500
+
+RECEIVED = "received"
+SUPERSEDED = "superseded"
+
+_journal_lock = threading.Lock()
+_appends_since_check = 0
 
 
 def init_storage() -> None:
     """
-    Initializes the storage directory and json file if they don't exist
+    Initializes the storage directory and journal file if they don't exist
     """
     os.makedirs(STORAGE_DIR, exist_ok=True)
 
-    if not os.path.exists(STORAGE_FILE):
-        with open(STORAGE_FILE, "w", encoding="utf-8") as file:
-            json.dump({}, file)
+    if not os.path.exists(JOURNAL_FILE):
+        open(JOURNAL_FILE, "a", encoding="utf-8").close()
 
 
-def save_message(messages: dict) -> None:
+@metrics.timer("storage_write_seconds", store="journal")
+def append_records(records: list[dict]) -> None:
     """
-    Saves a message and its response to the json file
-
-    param messages dict with keys as phone numbers and values are dict of message details
+    Appends records to the messages journal, one json object per line
 
+    :param records: list of record dicts
     :return: None
     """
+    global _appends_since_check
+    if not records:
+        return
+    lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
     try:
-        with open(STORAGE_FILE, "w", encoding="utf-8") as file:
-            json.dump(messages, file, ensure_ascii=False, indent=4)
+        with _journal_lock:
+            os.makedirs(STORAGE_DIR, exist_ok=True)
+            with open(JOURNAL_FILE, "a", encoding="utf-8") as file:
+                file.write(lines)
+                file.flush()
+                os.fsync(file.fileno())
+            _appends_since_check += len(records)
     except IOError as e:
         print(f"Error saving messages: {e}")
+        return
+    if _appends_since_check >= COMPACT_CHECK_EVERY:
+        maybe_compact_journal()
+
+
+def make_record(number: str, message: dict, status: str, code=None, response=None) -> dict:
+    """
+    Builds a journal record of a message
+
+    :param number: phone number the message came from
+    :param message: dict with 'receivedAt' and 'text' keys
+    :param status: 'received' before the message is handled, 'done' or 'superseded' afterward
+    :param code: handler's status code
+    :param response: handler's response text
+    :return: record dict
+    """
+    return {
+        "id": message_hash(message),
+        "number": str(number),
+        "receivedAt": message.get("receivedAt"),
+        "text": message.get("text"),
+        "status": status,
+        "code": code,
+        "response": response,
+        "at": datetime.now().isoformat()
+    }
+
+
+def save_message(messages: dict) -> None:
+    """
+    Journals received messages before they are handled
+
+    param messages dict with keys as phone numbers and values are lists of message details
+
+    :return: None
+    """
+    append_records([make_record(number, message, RECEIVED)
+                    for number, data in messages.items() for message in data])
 
 
-def get_all_messages() -> dict:
+def save_outcome(number: str, message: dict, outcome, status: str = "done") -> None:
     """
-    Gets all stored messages.
+    Journals the outcome of a handled message
+
+    :param number: phone number the message came from
+    :param message: dict with 'receivedAt' and 'text' keys
+    :param outcome: handler's return value, tuple of status code and response or None
+    :param status: final status of the message
+    :return: None
+    """
+    code, response = outcome if isinstance(outcome, tuple) else (None, outcome)
+    append_records([make_record(number, message, status, code, str(response) if response is not None else None)])
+
+
+def get_all_messages() -> Iterator[dict]:
     """
+    Streams all journal records lazily, oldest first.
+    Corrupted lines (e.g. a half-written last line after a crash) are skipped.
+    """
+    if not os.path.exists(JOURNAL_FILE):
+        return
     try:
-        if not os.path.exists(STORAGE_FILE):
-            print(f"Storage file not found. Initializing storage: ")
-            init_storage()
+        with open(JOURNAL_FILE, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    except IOError as e:
+        print(f"Error reading from storage file: {e} ")
 
+
+def get_snapshot_messages() -> dict:
+    """
+    Gets messages from the legacy messages.json snapshot.
+    """
+    try:
         with open(STORAGE_FILE, "r", encoding="utf-8") as file:
             return json.load(file)
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from storage: {e}. Re-init storage:")
-        init_storage()
+    except (IOError, json.JSONDecodeError):
         return {}
+
+
+def get_pending_messages() -> list:
+    """
+    Finds journaled messages that were received but never got an outcome,
+    e.g. because of a crash in the middle of a poll cycle.
+
+    :return: list of {number: message} dicts in receiving order
+    """
+    pending = {}
+    for record in get_all_messages():
+        key = (record["number"], record["id"])
+        if record["status"] == RECEIVED:
+            pending[key] = {record["number"]: {"text": record["text"], "receivedAt": record["receivedAt"]}}
+        else:
+            pending.pop(key, None)
+    return list(pending.values())
+
+
+def compact_journal(keep_per_number: int = JOURNAL_KEEP_PER_NUMBER) -> None:
+    """
+    Rewrites the journal keeping only the latest records of every number
+    and records of messages that are still pending.
+
+    :param keep_per_number: amount of records to keep for every phone number
+    :return: None
+    """
+    global _appends_since_check
+    with _journal_lock:
+        latest = {}
+        pending = {}
+        for index, record in enumerate(get_all_messages()):
+            kept = latest.setdefault(record["number"], [])
+            kept.append((index, record))
+            if len(kept) > keep_per_number:
+                kept.pop(0)
+            key = (record["number"], record["id"])
+            if record["status"] == RECEIVED:
+                pending[key] = (index, record)
+            else:
+                pending.pop(key, None)
+        records = {index: record for kept in latest.values() for index, record in kept}
+        records.update(pending.values())
+        temp_file = JOURNAL_FILE + ".tmp"
+        try:
+            with open(temp_file, "w", encoding="utf-8") as file:
+                for index in sorted(records):
+                    file.write(json.dumps(records[index], ensure_ascii=False) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file, JOURNAL_FILE)
+        except IOError as e:
+            print(f"Error compacting messages journal: {e}")
+        _appends_since_check = 0
+
+
+def maybe_compact_journal() -> None:
+    """
+    Compacts the journal if it became bigger than JOURNAL_MAX_BYTES
+    """
+    global _appends_since_check
+    try:
+        too_big = os.path.getsize(JOURNAL_FILE) > JOURNAL_MAX_BYTES
+    except OSError:
+        return
+    if too_big:
+        compact_journal()
+    else:
+        _appends_since_check = 0
+
+
+def message_hash(message: dict) -> str:
+    """
+    Builds a short id of a message out of its timestamp and text
+
+    :param message: dict with 'receivedAt' and 'text' keys
+    :return: hex digest
+    """
+    raw = f"{message.get('receivedAt', '')}|{message.get('text', '')}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def build_cursor(messages: dict, records=()) -> dict:
+    """
+    Builds a cursor out of a messages dict and journal records: for every phone number keeps
+    the timestamp of the latest message and ids of messages received at that very timestamp
+
+    :param messages: dict with keys as phone numbers and values are lists of message details
+    :param records: iterable of journal records
+    :return: cursor dict
+    """
+    cursor = {}
+    for number, data in (messages or {}).items():
+        for message in data:
+            advance_cursor(cursor, number, message)
+    for record in records:
+        advance_cursor(cursor, record["number"], record)
+    return cursor
+
+
+def advance_cursor(cursor: dict, number: str, message: dict) -> None:
+    """
+    Moves number's high-water mark forward if message is newer than it
+
+    :param cursor: cursor dict to update in place
+    :param number: phone number the message came from
+    :param message: dict with 'receivedAt' and 'text' keys
+    """
+    received_at = message["receivedAt"].split("+")[0]
+    mark = cursor.setdefault(str(number), {"last": "", "seen": []})
+    if received_at > mark["last"]:
+        mark["last"] = received_at
+        mark["seen"] = [message_hash(message)]
+    elif received_at == mark["last"] and message_hash(message) not in mark["seen"]:
+        mark["seen"].append(message_hash(message))
+
+
+def is_after_cursor(cursor: dict, number: str, message: dict) -> bool:
+    """
+    Checks if message wasn't processed yet according to the cursor.
+    Timestamps from the API are fixed-width ISO strings, so they are compared as text.
+
+    :return: True if message is newer than number's high-water mark
+    """
+    mark = cursor.get(str(number))
+    if not mark:
+        return True
+    received_at = message["receivedAt"].split("+")[0]
+    if received_at != mark["last"]:
+        return received_at > mark["last"]
+    return message_hash(message) not in mark["seen"]
+
+
+def load_cursor() -> dict:
+    """
+    Loads messages cursor from storage. If there is no cursor yet,
+    builds it from the journal and the legacy snapshot, so messages won't be processed twice.
+
+    :return: cursor dict
+    """
+    try:
+        with open(CURSOR_FILE, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return build_cursor(get_snapshot_messages(), get_all_messages())
+    except json.JSONDecodeError as e:
+        print(f"Error decoding cursor: {e}. Rebuilding it from stored messages:")
+        return build_cursor(get_snapshot_messages(), get_all_messages())
+
+
+@metrics.timer("storage_write_seconds", store="cursor")
+def save_cursor(cursor: dict) -> None:
+    """
+    Saves messages cursor to storage
+
+    :param cursor: cursor dict
+    :return: None
+    """
+    try:
+        os.makedirs(STORAGE_DIR, exist_ok=True)
+        temp_file = CURSOR_FILE + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump(cursor, file, ensure_ascii=False)
+        os.replace(temp_file, CURSOR_FILE)
     except IOError as e:
-        print(f"Error reading from storage file: {e} ")
-        return {}
+        print(f"Error saving cursor: {e}")
 
 
 def save_messages_api(team_name: str) -> None:
     """
-    Gets messages from the API and saves them to storage
+    Gets messages from the API and journals the ones that are newer than the cursor
     dict only, no list wrappers
 
     :param team_name: Name of team to get the messages
@@ -73,8 +325,16 @@ def save_messages_api(team_name: str) -> None:
                 if isinstance(msg_list, list):
                     api_messages[number] = msg_list
 
-            if api_messages:
-                save_message(api_messages)
+            cursor = load_cursor()
+            new_messages = {}
+            for number, msg_list in api_messages.items():
+                for message in msg_list:
+                    if is_after_cursor(cursor, number, message):
+                        advance_cursor(cursor, number, message)
+                        new_messages.setdefault(number, []).append(message)
+            if new_messages:
+                save_message(new_messages)
+                save_cursor(cursor)
         else:
             print(f"Unexpected message format: {api_messages}")
     except Exception as e:
@@ -1,12 +1,23 @@
 """Module interacts with user persistence storage"""
 import os
 import json
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
 from modules.attractions import final_fetch, get_api_key
+import modules.metrics as metrics
 
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-STORAGE_DIR = os.path.join(BASE_DIR, "storage")
+STORAGE_DIR = os.getenv("STORAGE_DIR", os.path.join(BASE_DIR, "storage"))
 STORAGE_FILE = os.path.join(STORAGE_DIR, "users.json")
+DB_FILE = os.path.join(STORAGE_DIR, "users.db")
+# 'sqlite' keeps one row per phone number, 'json' keeps the legacy users.json file
+STORAGE_BACKEND = os.getenv("USERS_BACKEND", "sqlite")
+
+_connection = None
+_lock = threading.RLock()
 
 
 def init_storage() -> None:
@@ -38,20 +49,96 @@ def load_user() -> dict:
         return {}
 
 
+@metrics.timer("storage_write_seconds", store="users")
 def save_user(user: dict) -> None:
     """
     Saves the users dict to the storage file.
+    Writes a temporary file first and renames it over users.json,
+    so a crash can't leave the storage half-written.
 
     :param user: dict of users to save
     :return: None
     """
     try:
-        with open(STORAGE_FILE, "w", encoding="utf-8") as file:
-            json.dump(user, file, ensure_ascii=False, indent=4)
+        os.makedirs(STORAGE_DIR, exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(dir=STORAGE_DIR, prefix=".users.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(user, file, ensure_ascii=False, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file, STORAGE_FILE)
+        except BaseException:
+            os.remove(temp_file)
+            raise
     except IOError as e:
         print(f"Error saving users : {e}")
 
 
+def get_connection() -> sqlite3.Connection:
+    """
+    Opens (once per process) the sqlite users database in WAL mode.
+    Creates the users table and imports users.json on the very first run.
+
+    :return: Shared sqlite connection
+    """
+    global _connection
+    with _lock:
+        if _connection is None:
+            os.makedirs(STORAGE_DIR, exist_ok=True)
+            is_new = not os.path.exists(DB_FILE)
+            connection = sqlite3.connect(DB_FILE, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS users ("
+                               "phone_number TEXT PRIMARY KEY, "
+                               "data TEXT NOT NULL)")
+            connection.commit()
+            _connection = connection
+            if is_new and os.path.exists(STORAGE_FILE):
+                migrate_json_to_sqlite()
+        return _connection
+
+
+def migrate_json_to_sqlite(json_file: str = STORAGE_FILE) -> int:
+    """
+    One-shot migration of the legacy users.json layout into the sqlite database.
+    Users that already exist in the database are left untouched.
+
+    :param json_file: Path to the legacy users.json
+    :return: Amount of migrated users
+    """
+    try:
+        with open(json_file, "r", encoding="utf-8") as file:
+            users = json.load(file)
+    except (IOError, json.JSONDecodeError) as e:
+        print(f"Error reading {json_file} for migration: {e}")
+        return 0
+    connection = get_connection()
+    with _lock, connection:
+        cursor = connection.executemany(
+            "INSERT OR IGNORE INTO users (phone_number, data) VALUES (?, ?)",
+            [(str(number), json.dumps(data, ensure_ascii=False)) for number, data in users.items()])
+    return cursor.rowcount
+
+
+def _read_user(phone_number: str) -> dict | None:
+    """Reads one user record from the sqlite database."""
+    with _lock:
+        row = get_connection().execute("SELECT data FROM users WHERE phone_number = ?",
+                                       (str(phone_number),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+@metrics.timer("storage_write_seconds", store="users")
+def _write_user(phone_number: str, user: dict) -> None:
+    """Writes one user record to the sqlite database."""
+    connection = get_connection()
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO users (phone_number, data) VALUES (?, ?)",
+                           (str(phone_number), json.dumps(user, ensure_ascii=False)))
+
+
 def user_exists(phone_number: str) -> bool:
     """
     Checks if user exists in storage
@@ -59,8 +146,12 @@ def user_exists(phone_number: str) -> bool:
     :param phone_number: User phone_number
     :return: True if user exist, False if not.
     """
-    users = load_user()
-    return phone_number in users
+    if STORAGE_BACKEND == "json":
+        return str(phone_number) in load_user()
+    with _lock:
+        row = get_connection().execute("SELECT 1 FROM users WHERE phone_number = ?",
+                                       (str(phone_number),)).fetchone()
+    return row is not None
 
 
 def init_user(phone_number, location: str = '', attr_type: str = '',
@@ -74,19 +165,29 @@ def init_user(phone_number, location: str = '', attr_type: str = '',
     :param attractions: List of attractions
     :param index: Starting index (0)
     """
-    users = load_user()
-
-    if not user_exists(phone_number):
-        # Add the user to storage
-        users[phone_number] = {
-            "location": location,
-            "type": attr_type,
-            "attraction": attractions,
-            "index": index
-        }
-        save_user(users)
-    else:
-        print(f"User with phone number {phone_number} already exists. ")
+    user = {
+        "location": location,
+        "type": attr_type,
+        "attraction": attractions,
+        "index": index
+    }
+    with _lock:
+        if STORAGE_BACKEND == "json":
+            users = load_user()
+            if str(phone_number) not in users:
+                # Add the user to storage
+                users[str(phone_number)] = user
+                save_user(users)
+                return
+        else:
+            connection = get_connection()
+            with connection:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO users (phone_number, data) VALUES (?, ?)",
+                    (str(phone_number), json.dumps(user, ensure_ascii=False)))
+            if cursor.rowcount:
+                return
+    print(f"User with phone number {phone_number} already exists. ")
 
 
 def get_user(phone_number: str) -> dict:
@@ -97,8 +198,50 @@ def get_user(phone_number: str) -> dict:
 
     :return: Dictionary of user's data or None if user doesn't exist.
     """
-    users = load_user()
-    return users.get(phone_number)
+    if STORAGE_BACKEND == "json":
+        return load_user().get(str(phone_number))
+    return _read_user(phone_number)
+
+
+@contextmanager
+def user_transaction(phone_number: str):
+    """
+    Context manager that yields user's data dict and saves all the changes
+    made to it with a single write when the block exits without errors.
+    Yields None if user doesn't exist.
+
+    :param phone_number: User's phone number
+    """
+    with _lock:
+        if STORAGE_BACKEND == "json":
+            users = load_user()
+            user = users.get(str(phone_number))
+        else:
+            user = _read_user(phone_number)
+        yield user
+        if user is None:
+            return
+        if STORAGE_BACKEND == "json":
+            users[str(phone_number)] = user
+            save_user(users)
+        else:
+            _write_user(phone_number, user)
+
+
+def update_user(phone_number: str, **fields) -> bool:
+    """
+    Updates several user's attributes at once with a single write
+
+    :param phone_number: User's phone number
+    :param fields: Attributes to update ('location', 'type', 'attraction', 'index')
+    :return: True if user was updated, False if user doesn't exist
+    """
+    with user_transaction(phone_number) as user:
+        if user is None:
+            print(f"User {phone_number} doesn't exist. Check again")
+            return False
+        user.update(fields)
+    return True
 
 
 def set_user_attribute(phone_number: str, attribute: str, value) -> None:
@@ -109,12 +252,7 @@ def set_user_attribute(phone_number: str, attribute: str, value) -> None:
     :param attribute: Attribute to update('location, 'type', 'attractions', 'index')
     :param value: New value for the attribute
     """
-    users = load_user()
-    if user_exists(phone_number):
-        users[phone_number][attribute] = value
-        save_user(users)
-    else:
-        print(f"User {phone_number} doesn't exist. Check again")
+    update_user(phone_number, **{attribute: value})
 
 
 def get_user_attribute(phone_number: str, attribute: str):
@@ -2,15 +2,23 @@ from dotenv import load_dotenv
 from datetime import datetime
 import os
 from random import randint
-import re
+import threading
 
 from modules.messages_manager import register_number, unregister_number, read_messages, send_message
 import modules.sms_builder as sms_builder
-from modules.storage_manager import save_message, get_all_messages
-from modules.attractions import geocode_city_finder, final_fetch
+import modules.categories as categories
+import modules.commands as parser
+import modules.sms_segments as sms_segments
+import modules.outbox as outbox
+import modules.app_logger as app_logger
+import modules.metrics as metrics
+from modules.storage_manager import (save_message, save_outcome, get_all_messages, save_cursor,
+                                     advance_cursor, is_after_cursor, message_hash, append_records,
+                                     make_record, SUPERSEDED)
+from modules.attractions import geocode_city_finder, final_fetch, surprise_fetch, MAPS_URL
 import modules.storage_users as storage_users
 
-from main import DEBUG, SEND_SMS
+from main import DEBUG, SEND_SMS, OUTBOX
 
 load_dotenv()
 some_phone_number = int(os.getenv('some_number'))
@@ -18,29 +26,20 @@ sms_commands = {}
 TEAM_NAME = 'Attraction'
 LOG_FILENAME = os.path.join('storage', 'app.log')
 DEV_LOG = 'app.log'
+QUEUED = 202
+_inbound = threading.local()
 # SEND_SMS = False
 # DEBUG = True
 
 
 def add_log_record(status: int, record: str, log_file: str = LOG_FILENAME):
-    """Adds a record to a log file with date stamp, status code and message"""
-    record = ' '.join(record.split('\n'))
-    record = re_obfuscate(record)
-    with open(log_file, 'a', encoding='utf8') as log:
-        log.write(f'{datetime.now()}\t{status} {record}\n')
+    """Adds a record to a log file with date stamp, status code and message.
+    The record is written by a background thread"""
+    app_logger.log(status, record, log_file)
 
 
 def re_obfuscate(text: str) -> str:
-    patterns = [r'destination":"(\d*)?"',
-                r'Number "(\d*)?"',
-                r'Error: The number "(\d*)?"']
-
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            start, end = match.span(1)
-            text = text[:start] + '*' * (end - start - 4) + text[end - 4:]
-    return text
+    return app_logger.obfuscate_text(text)
 
 
 def obfuscate(func):
@@ -68,47 +67,105 @@ def str_to_datetime(text: str) -> datetime:
     return datetime.fromisoformat(text.split('+')[0])
 
 
-def filter_new_messages(old: dict, new: dict | list) -> list:
-    """Takes two dicts. Returns a list of messages that are present in new messages
-    and are absent in old ones. Logs amount of returned messages.
-    Overwrites messages' storage
+def filter_new_messages(cursor: dict, new: dict | list) -> list:
+    """Takes messages cursor and a dict of messages from API. Returns a list of messages
+    that are newer than the cursor, sorted by receiving time. Logs amount of returned messages.
+    Advances the cursor and persists it together with new messages only.
     """
-    if isinstance(new, list) and new:
-        new = new[0]
-    if old:
-        old_last_message = get_last_message_time(old)
-    else:
-        old_last_message = datetime(1, 1, 1)
-    new_last_message = get_last_message_time(new)
-    if new_last_message == old_last_message:
-        return []
+    if isinstance(new, list):
+        new = new[0] if new else {}
     new_messages = []
     for number, messages in new.items():
-        new_messages += [{number: message}
-                         for message in sorted(messages, key=lambda a: str_to_datetime(a['receivedAt']))
-                         if str_to_datetime(message['receivedAt']) > old_last_message]
+        new_messages += [{number: message} for message in messages
+                         if is_after_cursor(cursor, number, message)]
+    if not new_messages:
+        return []
+    new_messages.sort(key=lambda item: next(iter(item.values()))['receivedAt'].split('+')[0])
     add_log_record(102, f'Found {len(new_messages)} new messages. Processing...')
-    save_message(new)
+    new_by_number = {}
+    for item in new_messages:
+        for number, message in item.items():
+            advance_cursor(cursor, number, message)
+            new_by_number.setdefault(number, []).append(message)
+    save_message(new_by_number)
+    save_cursor(cursor)
     return new_messages
 
 
-def process_new_message(message: dict, commands: dict = sms_commands):
-    """Parses one message dict and runs corresponding command"""
+def process_new_message(message: dict, commands: dict = sms_commands, command: parser.Command | None = None):
+    """Parses one message dict and runs corresponding command
+
+    :param message: {number: message} dict
+    :param commands: dict with command names as keys and handlers as values
+    :param command: already parsed text of the message
+    """
     for user_number, data in message.items():
-        for command in commands:
-            if data['text'].startswith(command):
-                command, *text = data['text'].strip().split(' ')
-                text = ' '.join(text)
-                return commands.get(command, commands['DOCS'])(user_number=user_number, text=text)
-        text = data['text'].strip()
-        return commands['DOCS'](user_number=user_number, text=text)
+        if command is None:
+            command = parser.parse(data['text'])
+        return commands.get(command.name, commands[parser.FALLBACK])(user_number=user_number, text=command.argument)
+
+
+def handle_message(message: dict, command: parser.Command | None = None, commands: dict = sms_commands):
+    """Runs the command of one message and journals its outcome"""
+    outcome = None
+    user_number, data = next(iter(message.items()))
+    # replies are keyed by the inbound message, so a replayed message doesn't send them twice
+    _inbound.key = f'{user_number}:{message_hash(data)}'
+    _inbound.replies = 0
+    if command is None:
+        command = parser.parse(data['text'])
+    try:
+        with metrics.timer('handler_seconds', command=command.name if command.name in commands else parser.FALLBACK):
+            outcome = process_new_message(message, commands, command)
+        return outcome
+    finally:
+        _inbound.key = None
+        save_outcome(user_number, data, outcome)
+
+
+def skip_messages(skipped: list) -> None:
+    """Journals messages that won't be run because later messages of the same batch override them
+
+    :param skipped: list of tuples ({number: message}, reason)
+    """
+    if not skipped:
+        return
+    add_log_record(100, f'Skipping {len(skipped)} superseded messages')
+    append_records([make_record(number, data, SUPERSEDED, response=reason)
+                    for message, reason in skipped for number, data in message.items()])
+
+
+def send_sms(user_number: int, sms_text: str) -> tuple[int, str]:
+    """Fits sms text into as few segments as configured, logs its encoding
+    and segments count and sends it. With OUTBOX the sms is queued for the background sender
+    and 202 is returned right away"""
+    sms_text, info = sms_segments.fit(sms_text)
+    add_log_record(100, f'Sending sms: {info.encoding}, {info.units} units, {info.segments} segment(s)')
+    if not OUTBOX:
+        return send_message(user_number, sms_text)
+    key = None
+    if getattr(_inbound, 'key', None):
+        key = f'{_inbound.key}:{_inbound.replies}'
+        _inbound.replies += 1
+    if outbox.enqueue(user_number, sms_text, key):
+        return QUEUED, 'Message queued. '
+    return QUEUED, 'Message was already queued. '
+
+
+def attraction_sms(attraction: list) -> tuple[list, str]:
+    """Takes a stored attraction [name, long url] and shortens its url unless it was done before.
+    Returns the attraction with memoized short url [name, long url, short url] and its sms text"""
+    name, url, *short_url = attraction
+    if not short_url:
+        short_url = [sms_builder.make_url_short(url) if url.startswith(MAPS_URL) else url]
+    return [name, url, short_url[0]], '\n'.join([name, short_url[0]])
 
 
 def user_doesnt_exist(user_number):
     if not storage_users.user_exists(str(user_number)):
         sms_text = sms_builder.subscribe_text()
         if SEND_SMS:
-            code, message = send_message(user_number, sms_text)
+            code, message = send_sms(user_number, sms_text)
             return True, (code, message)
         return True, (200, f'user sort of got a message: {sms_text}')
     return False, (200, 'user does exists')
@@ -135,7 +192,7 @@ def subscribe_user(user_number: int,
         storage_users.init_user(user_number, None, None, None)
         if SEND_SMS:
             sms_text = sms_builder.welcome_text()
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
     add_log_record(code, message)
@@ -160,7 +217,7 @@ def unsubscribe_user(user_number: int,
     if code == 200:
         if SEND_SMS:
             sms_text = sms_builder.goodbye_text()
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
     return code, message
@@ -182,17 +239,15 @@ def set_location(user_number: int,
     if not coords:
         sms_text = sms_builder.city_not_found_text()
         if SEND_SMS:
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(f'400 {sms_code}', sms_message + sms_text)
             return f'400 {sms_code}', f'City not found. {sms_message}'
         add_log_record(400, f'user sort of got a messaga: {sms_text}')
         return f'400', f'user sort of got a messaga: {sms_text}'
-    storage_users.set_user_attribute(str(user_number), 'location', [text, coords])
-    storage_users.set_user_attribute(str(user_number), 'type', None)
-    storage_users.set_user_attribute(str(user_number), 'attraction', None)
+    storage_users.update_user(str(user_number), location=[text, coords], type=None, attraction=None)
     sms_text = sms_builder.attraction_type_text(text)
     if SEND_SMS:
-        sms_code, sms_message = send_message(user_number, sms_text)
+        sms_code, sms_message = send_sms(user_number, sms_text)
         add_log_record(sms_code, sms_message + sms_text)
         return sms_code, sms_message
     add_log_record(200, f'user sort of got a message: {sms_text}')
@@ -216,63 +271,69 @@ def set_attraction_type(user_number: int,
     if not storage_users.get_user_attribute(str(user_number), 'location'):
         sms_text = "Hold your horses! Send text 'LOCATION city' with your destination as a city first."
         if SEND_SMS:
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
         return 200, f'user sort of got a message: {sms_text}'
     api = os.getenv('GEOAPIFY_API_KEY')
-    attractions = sms_builder.get_attractions_list()
-    if text not in attractions + ['surprise']:
-        sms_text = sms_builder.wrong_attraction_text(text)
+    if text.strip().casefold() == 'surprise':
+        text = 'surprise'
+    elif not categories.is_category(text):
+        match = categories.match_category(text)
+        if match.best:
+            add_log_record(100, f'Resolved attraction type {text} to {match.best}')
+            text = match.best
+    if text != 'surprise' and not categories.is_category(text):
+        if match.shortlist:
+            sms_text = sms_builder.suggest_attraction_text(text, match.shortlist)
+        else:
+            sms_text = sms_builder.wrong_attraction_text(text)
         if SEND_SMS:
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
         add_log_record(200, f'user sort of got message: {sms_text}')
         return 200, f'user sort of got message: {sms_text}'
-    storage_users.set_user_attribute(str(user_number), 'type', text)
-
     start = 'Your attraction: '
     coords = storage_users.get_user_attribute(str(user_number), 'location')[1]
 
     if text == 'surprise':
-        for _ in range(3):
-            text = sms_builder.get_random_attraction_type()
+        code, text, message = surprise_fetch(coords[0], coords[1], 7000, api, shorten=False)
+        if code == 200 and message:  # non-empty list
             start = f'Your surprise is {text}\n'
-            code, message = final_fetch(coords[0], coords[1], 7000, text, api)
-            if code == 200 and message:  # non-empty list
-                storage_users.set_user_attribute(str(user_number), 'attraction', message)
-                storage_users.set_user_attribute(str(user_number), 'index', 0)
-                title, url = message[randint(0, len(message) - 1)]
-                sms_text = start + '\n'.join([title, url])
-                if SEND_SMS:
-                    sms_code, sms_message = send_message(user_number, sms_text)
-                    add_log_record(sms_code, sms_message + sms_text)
-                    return sms_code, sms_message
-                add_log_record(200, f'user sort of got a message: {sms_text}')
-                return 200, f'user sort of got a message: {sms_text}'
+            pick = randint(0, len(message) - 1)
+            message[pick], attraction = attraction_sms(message[pick])
+            storage_users.update_user(str(user_number), type='surprise', attraction=message, index=0)
+            sms_text = start + attraction
+            if SEND_SMS:
+                sms_code, sms_message = send_sms(user_number, sms_text)
+                add_log_record(sms_code, sms_message + sms_text)
+                return sms_code, sms_message
+            add_log_record(200, f'user sort of got a message: {sms_text}')
+            return 200, f'user sort of got a message: {sms_text}'
+        storage_users.set_user_attribute(str(user_number), 'type', 'surprise')
         sms_text = 'We are out of surprises right now. Try again later or pick another TYPE of attractions'
         if SEND_SMS:
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
         add_log_record(200, f'user sort of got a message: {sms_text}')
         return 200, f'user sort of got a message: {sms_text}'
 
-    code, message = final_fetch(coords[0], coords[1], 7000, text, api)
+    code, message = final_fetch(coords[0], coords[1], 7000, text, api, shorten=False)
     if code == 200 and message:  # non-empty list
-        storage_users.set_user_attribute(str(user_number), 'attraction', message)
-        storage_users.set_user_attribute(str(user_number), 'index', 0)
+        message[0], attraction = attraction_sms(message[0])
+        storage_users.update_user(str(user_number), type=text, attraction=message, index=0)
         if DEBUG: print(code, message)
-        title, url = message[0]
-        sms_text = start + '\n'.join([title, url])
+        sms_text = start + attraction
         if SEND_SMS:
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
         add_log_record(200, f'user sort of got a message: {sms_text}')
         return 200, f'user sort of got a message: {sms_text}'
-    elif code == 200:  # empty list
+    storage_users.set_user_attribute(str(user_number), 'type', text)
+    if code == 200:  # empty list
         start = 'We are not able to find something interesting with your LOCATION and TYPE. '
         end = 'Try changing TYPE or LOCATION and TYPE.'
         sms_text = start + end
@@ -289,7 +350,8 @@ def send_next_attraction(user_number: int,
                          obfuscated_number: str = '',
                          text: str = '',
                          team: str = TEAM_NAME) -> tuple[int, str]:
-    """Gets user info from a storage, sends nex attraction that corresponds to previous user's requests"""
+    """Gets user info from a storage, sends nex attraction that corresponds to previous user's requests.
+    'MORE 3' sends up to three next attractions (or three surprises) packed into as few sms as possible"""
     if DEBUG: print(f'this should send next attraction to {user_number} ({text=})')
     add_log_record(100, f'Sending next attraction to {obfuscated_number}')
     wrong_user, message = user_doesnt_exist(user_number)
@@ -298,27 +360,27 @@ def send_next_attraction(user_number: int,
         return message[0], message[1]
     location = storage_users.get_user_attribute(str(user_number), 'location')
     attr_type = storage_users.get_user_attribute(str(user_number), 'type')
+    count = max(1, int(text)) if text.isdigit() else 1
     if attr_type == 'surprise':
         coords = storage_users.get_user_attribute(str(user_number), 'location')[1]
-        for _ in range(3):
-            text = sms_builder.get_random_attraction_type()
-            start = f'Your surprise is {text}\n'
-            code, message = final_fetch(coords[0], coords[1], 7000, text, os.getenv('GEOAPIFY_API_KEY'))
-            if code == 200 and message:  # non-empty list
-                storage_users.set_user_attribute(str(user_number), 'attraction', message)
-                storage_users.set_user_attribute(str(user_number), 'index', 0)
-                title, url = message[randint(0, len(message) - 1)]
-                sms_text = start + '\n'.join([title, url])
-                if SEND_SMS:
-                    sms_code, sms_message = send_message(user_number, sms_text)
-                    add_log_record(sms_code, sms_message + sms_text)
-                    return sms_code, sms_message
-                add_log_record(200, f'user sort of received a message: {sms_text}')
-                return 200, f'user sort of received a message: {sms_text}'
+        texts, surprises = [], None
+        for _ in range(count):
+            code, category, message = surprise_fetch(coords[0], coords[1], 7000, os.getenv('GEOAPIFY_API_KEY'),
+                                                     shorten=False)
+            if code != 200 or not message:  # no surprises left
+                break
+            pick = randint(0, len(message) - 1)
+            message[pick], attraction = attraction_sms(message[pick])
+            surprises = message
+            texts.append(f'Your surprise is {category}\n' + attraction)
+        if texts:
+            storage_users.update_user(str(user_number), attraction=surprises, index=0)
+            sms_code, sms_message, _ = send_packed(user_number, texts)
+            return sms_code, sms_message
         sms_text = ('We are out of surprises right now. Try again later or pick another TYPE of attractions: '
                     'https://tinyurl.com/2yyxqodb')
         if SEND_SMS:
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
         add_log_record(200, f'user sort of received a message: {sms_text}')
@@ -333,7 +395,7 @@ def send_next_attraction(user_number: int,
             missing = "'LOCATION city' with your destination as a city first."
         sms_text = f'Hold your horses! Send text {missing}'
         if SEND_SMS:
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
         add_log_record(200, f'user sort of got a message: {sms_text}')
@@ -341,22 +403,36 @@ def send_next_attraction(user_number: int,
     if index + 1 == len(attractions):
         sms_text = sms_builder.newtype_text()
         if SEND_SMS:
-            sms_code, sms_message = send_message(user_number, sms_text)
+            sms_code, sms_message = send_sms(user_number, sms_text)
             add_log_record(sms_code, sms_message + sms_text)
             return sms_code, sms_message
         add_log_record(200, f'user sort of got a message: {sms_text}')
         return 200, f'user sort of got a message: {sms_text}'
-    sms_text = '\n'.join(attractions[index + 1])
-    if DEBUG: print(sms_text)
-    if SEND_SMS:
-        sms_code, sms_message = send_message(user_number, sms_text)
-        if sms_code == 200:
-            storage_users.set_user_attribute(str(user_number), 'index', index + 1)
-        add_log_record(sms_code, sms_message + sms_text)
-        return sms_code, sms_message
-    storage_users.set_user_attribute(str(user_number), 'index', index + 1)
-    add_log_record(200, f'user sort of got a message: {sms_text}')
-    return 200, f'user sort of got a message: {sms_text}'
+    texts = []
+    for position in range(index + 1, min(len(attractions), index + 1 + count)):
+        attractions[position], attraction = attraction_sms(attractions[position])
+        texts.append(attraction)
+    sms_code, sms_message, sent = send_packed(user_number, texts)
+    storage_users.update_user(str(user_number), attraction=attractions, index=index + sent)
+    return sms_code, sms_message
+
+
+def send_packed(user_number: int, texts: list) -> tuple[int, str, int]:
+    """Sends texts packed into as few sms as possible. Stops at the first sms that failed.
+    Returns code and response of the last sms and amount of texts that were sent"""
+    sms_code, sms_message, sent = 200, '', 0
+    for sms_text, amount in sms_builder.pack_texts(texts):
+        if DEBUG: print(sms_text)
+        if SEND_SMS:
+            sms_code, sms_message = send_sms(user_number, sms_text)
+            add_log_record(sms_code, sms_message + sms_text)
+            if sms_code not in (200, QUEUED):
+                break
+        else:
+            sms_message = f'user sort of got a message: {sms_text}'
+            add_log_record(200, sms_message)
+        sent += amount
+    return sms_code, sms_message, sent
 
 
 @obfuscate
@@ -370,7 +446,7 @@ def send_documentation(user_number: int,
     sms_text = ("We get: 'SUBSCRIBE Attraction', 'UNSUBSCRIBE Attraction', 'LOCATION Q', 'TYPE X', 'MORE', 'DOCS'."
                 "Q - your destination. X options: https://tinyurl.com/2yyxqodb")
     if SEND_SMS:
-        sms_code, sms_message = send_message(user_number, sms_text)
+        sms_code, sms_message = send_sms(user_number, sms_text)
         add_log_record(sms_code, sms_message + sms_text)
         return sms_code, sms_message
     add_log_record(200, f'user sort of got a message: {sms_text}')
@@ -385,6 +461,8 @@ def get_received_messages_api(team: str = 'Attraction') -> tuple[int, str]:
         if isinstance(message, list) and not message:
             message = {}
         return code, message
+    add_log_record(code, message)
+    return code, message
 
 
 sms_commands.update({
@@ -0,0 +1,120 @@
+"""Module runs a small HTTP server that receives inbound messages pushed by the SMS provider.
+Accepted payloads: the getMessages layout {number: [message, ...]}, a single
+{"phoneNumber": ..., "text": ..., "receivedAt": ...} object or a list of such objects.
+Every message needs the provider's receivedAt: the cursor and deduplication against the backstop poll
+rely on it, so payloads without it are rejected with 400 instead of being stamped with the local clock."""
+import ipaddress
+import json
+import os
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WEBHOOK_PATH = "/messages"
+WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN")  # expected in X-Webhook-Token header if set
+MAX_BODY = 1024 * 1024
+
+
+def to_inbox(payload) -> dict:
+    """
+    Converts a webhook payload into the getMessages layout
+
+    :param payload: parsed json body
+    :return: dict with phone numbers as keys and lists of message dicts as values
+    """
+    if isinstance(payload, dict) and "phoneNumber" not in payload:
+        inbox = {}
+        for number, messages in payload.items():
+            if not isinstance(messages, list):
+                raise ValueError(f"messages of {number} are not a list")
+            inbox[check_number(number)] = [check_message(message) for message in messages]
+        return inbox
+    items = payload if isinstance(payload, list) else [payload]
+    inbox = {}
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError("message is not an object")
+        message = check_message({"text": item.get("text", ""), "receivedAt": item.get("receivedAt")})
+        inbox.setdefault(check_number(item["phoneNumber"]), []).append(message)
+    return inbox
+
+
+def check_number(number) -> str:
+    """Returns phone number as a string or raises ValueError if it isn't one"""
+    text = str(number)
+    if not text.lstrip("+").isdigit():
+        raise ValueError(f"{text!r} is not a phone number")
+    return text
+
+
+def check_message(message) -> dict:
+    """Returns message dict with text and receivedAt or raises ValueError if it's malformed"""
+    if not isinstance(message, dict):
+        raise ValueError("message is not an object")
+    text, received_at = message.get("text"), message.get("receivedAt")
+    if not isinstance(text, str) or not isinstance(received_at, str):
+        raise ValueError("message needs 'text' and 'receivedAt' strings")
+    datetime.fromisoformat(received_at.split("+")[0])
+    return {"text": text, "receivedAt": received_at}
+
+
+def is_loopback(host: str) -> bool:
+    """Checks if host is only reachable from this machine"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def make_handler(on_messages):
+    """Builds a request handler class that passes received inboxes to on_messages"""
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.split("?")[0] != WEBHOOK_PATH:
+                return self.reply(404, "Not found")
+            if WEBHOOK_TOKEN and self.headers.get("X-Webhook-Token") != WEBHOOK_TOKEN:
+                return self.reply(403, "Forbidden")
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY:
+                return self.reply(413, "Payload too large")
+            try:
+                inbox = to_inbox(json.loads(self.rfile.read(length) or b"null"))
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                return self.reply(400, f"Bad payload: {e}")
+            accepted = on_messages(inbox)
+            self.reply(202, f"Accepted {accepted} new messages")
+
+        def reply(self, code: int, text: str) -> None:
+            body = text.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookHandler
+
+
+def start_server(host: str, port: int, on_messages) -> ThreadingHTTPServer:
+    """
+    Starts webhook server in a background thread
+
+    :param host: Interface to listen on
+    :param port: Port to listen on
+    :param on_messages: function that takes an inbox dict and returns amount of new messages
+    :return: running server
+    :raises ValueError: if host isn't a loopback one and WEBHOOK_TOKEN isn't set
+    """
+    if not WEBHOOK_TOKEN and not is_loopback(host):
+        raise ValueError(f"Refusing to listen on {host} without WEBHOOK_TOKEN: "
+                         f"anyone could inject messages. Set WEBHOOK_TOKEN or use 127.0.0.1")
+    server = ThreadingHTTPServer((host, port), make_handler(on_messages))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    return server